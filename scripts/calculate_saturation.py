@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 
-import random
 import json
+import multiprocessing
+import numpy as np
 import pandas as pd
+import os
 import argparse
-from utils import read_json_config, fa2dict, get_bc_umi_counts, write_dict_to_tsv
+from scipy.special import gammaln
+from utils import read_json_config, fa2dict, get_bc_umi_counts, write_dict_to_tsv, read_umi_hist, log_info
 
-random.seed(42)
+# numpy multivariate_hypergeometric requires fewer than 1e9 reads in total
+MAX_HYPERGEOMETRIC_READS = 10**9
 
 def setup_and_parse_args():
     parser = argparse.ArgumentParser(description="Saturation Correction.")
@@ -14,6 +18,22 @@ def setup_and_parse_args():
     parser.add_argument("-i", "--input_dir", required=True, help="Path to the input path")
     parser.add_argument("-o", "--output_dir", required=True, help="Path to the output path")
     parser.add_argument("-c", "--config", required=True, help="Path to the config json")
+    parser.add_argument("--sampler", default="hypergeometric", choices=["hypergeometric", "binomial"],
+                        help="hypergeometric: exact draws without replacement; binomial: binomial thinning, a fast approximation")
+    parser.add_argument("--mode", default="independent", choices=["independent", "nested", "analytic"],
+                        help="independent: draw every ratio from scratch; nested: derive all ratios from one random ordering of the reads; "
+                             "analytic: expected curve computed from the reads-per-UMI histogram without sampling")
+    parser.add_argument("--n_ratios", type=int, default=0,
+                        help="number of log-spaced ratios between 0.0001 and 0.9, 0 for the default 36-point grid")
+    parser.add_argument("--group_by", nargs="*", default=[], choices=["FB", "PB"],
+                        help="also report the saturation curves per feature barcode and/or per PB")
+    parser.add_argument("--refine_steps", type=int, default=0,
+                        help="bisection steps to refine the optimal ratio below the first grid point reaching the maximal saturation "
+                             "(nested and analytic modes), 0 to disable")
+    parser.add_argument("--replicates", type=int, default=1, help="number of downsampling replicates per ratio")
+    parser.add_argument("--ci", type=float, default=95, help="width of the percentile band over replicates, in percent")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="number of processes for the replicates")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
     args = parser.parse_args()
     return args
 
@@ -31,59 +51,281 @@ def parse_json_config(config):
 
     return barcode2_ref, per_barcode1_len
 
-def gen_sample_pool(dct):
-    # Create a sample pool by expanding each barcode-umi according to its occurrence count
-    sample_pool = []
-    for barcode, umis in dct.items():
-        for umi, count in umis.items():
-            sample_pool.extend([f"{barcode}-{umi}"] * count)
-    return sample_pool
-
-def compute_seq_saturation(barcode_dict):
-    # Compute sequencing saturation and duplication ratio
-    UMI_counts = []
-    for subdict in barcode_dict.values():
-        UMI_counts.extend(subdict.values())
-    counts_matrix = pd.Series(UMI_counts).value_counts()
-    counts_matrix = counts_matrix.sort_index()
-    bins = counts_matrix.index.to_list()
-    counts = counts_matrix.to_list()
-
-    if len(counts) == 0:
-        return round(0, 2), 0, 0, round(0, 2)
-    single = counts[0]
-    n_duplicate_set = sum(counts)
-    total, dup = 0, 0
-    for i in range(0, len(bins)):
-        total += bins[i] * counts[i]
-        dup += (bins[i] - 1) * counts[i]
-    duplication_ratio = (dup) * 100 / (total)
-    seq_saturation = (1 - (single / n_duplicate_set)) * 100
-    return round(seq_saturation, 2), single, n_duplicate_set, round(duplication_ratio, 2)
+def dict2arrays(dct):
+    # Flatten {barcode: {umi: count}} into per-molecule arrays, so memory scales with molecules instead of reads
+    barcodes = list(dct.keys())
+    sizes = np.fromiter((len(umis) for umis in dct.values()), dtype=np.int64, count=len(barcodes))
+    bc_codes = np.repeat(np.arange(len(barcodes)), sizes)
+    umis = [umi for umi_counts in dct.values() for umi in umi_counts]
+    counts = np.fromiter((count for umi_counts in dct.values() for count in umi_counts.values()),
+                         dtype=np.int64, count=int(sizes.sum()))
+    return barcodes, bc_codes, umis, counts
 
-def downsample(dct, downsample_ratio):
-    # Downsampling functions
-    sample_pool = gen_sample_pool(dct)
-    sample_size = int(len(sample_pool) * downsample_ratio)
-    sampled_items = random.sample(sample_pool, sample_size)
-    # Create a new dictionary to store the sampled results
+def arrays2dict(barcodes, bc_codes, umis, counts):
+    # Rebuild the nested dictionary, molecules without any sampled read are dropped
     sampled_dict = {}
-    # Group the sampled items by barcode and umi
-    for item in sampled_items:
-        barcode, umi = item.split('-')
+    idxs = np.flatnonzero(counts)
+    for idx, bc_code, count in zip(idxs.tolist(), bc_codes[idxs].tolist(), counts[idxs].tolist()):
+        barcode = barcodes[bc_code]
         if barcode not in sampled_dict:
             sampled_dict[barcode] = {}
-        if umi not in sampled_dict[barcode]:
-            sampled_dict[barcode][umi] = 0
-        sampled_dict[barcode][umi] += 1
+        sampled_dict[barcode][umis[idx]] = count
     return sampled_dict
 
+def hist_saturation(hist):
+    # Compute sequencing saturation and duplication ratio from the reads-per-UMI histogram,
+    # hist[k] is the number of UMIs supported by k reads
+    hist = np.asarray(hist)
+    n_duplicate_set = int(hist[1:].sum())
+    if n_duplicate_set == 0:
+        return round(0, 2), 0, 0, round(0, 2)
+    single = int(hist[1])
+    total = int((np.arange(len(hist)) * hist).sum())
+    dup = total - n_duplicate_set
+    duplication_ratio = (dup) * 100 / (total)
+    seq_saturation = (1 - (single / n_duplicate_set)) * 100
+    return round(seq_saturation, 2), single, n_duplicate_set, round(duplication_ratio, 2)
+
+def compute_seq_saturation(counts):
+    # Compute sequencing saturation and duplication ratio from per-molecule read counts
+    return hist_saturation(np.bincount(counts))
+
+def downsample(counts, downsample_ratio, rng, sampler="hypergeometric"):
+    # Draw the number of reads kept for each molecule at the given ratio
+    if sampler == "binomial":
+        return rng.binomial(counts, downsample_ratio)
+    sample_size = int(counts.sum() * downsample_ratio)
+    return rng.multivariate_hypergeometric(counts, sample_size)
+
+def nested_downsample(counts, ratios, rng, sampler="hypergeometric"):
+    # Evaluate every ratio as a threshold on one random ordering of the reads: each sample is drawn
+    # from the previous larger one, so the samples are nested and the curve comes from a single pass
+    total = counts.sum()
+    current, current_ratio = counts, 1
+    for ratio in sorted(ratios, reverse=True):
+        if sampler == "binomial":
+            current = rng.binomial(current, ratio / current_ratio)
+        else:
+            current = rng.multivariate_hypergeometric(current, int(total * ratio))
+        current_ratio = ratio
+        yield ratio, current
+
+def expected_probs(k, total, ratios, sampler="hypergeometric"):
+    # Probability that a UMI with k reads keeps none or exactly one of them when `total` reads
+    # are downsampled, returned per ratio (rows) and k (columns) with the expected read number
+    p = np.asarray(ratios, dtype=np.float64)[:, None]
+    if sampler == "binomial":
+        reads = total * p[:, 0]
+        p_zero = np.power(1 - p, k)
+        p_one = k * p * np.power(1 - p, k - 1)
+    else:
+        n = np.floor(total * p)
+        reads = n[:, 0]
+        # P(0 kept) = C(N-k, n) / C(N, n), P(1 kept) = k * C(N-k, n-1) / C(N, n)
+        log_base = gammaln(total - k + 1) + gammaln(total - n + 1) - gammaln(total + 1)
+        rest = total - k - n
+        with np.errstate(divide="ignore"):
+            p_zero = np.where(rest >= 0, np.exp(log_base - gammaln(np.maximum(rest, 0) + 1)), 0)
+            p_one = np.where((rest >= -1) & (n >= 1),
+                             np.exp(np.log(k * n) + log_base - gammaln(np.maximum(rest, -1) + 2)), 0)
+    return reads, p_zero, p_one
+
+def saturation_stats(types, single, reads):
+    # Vectorized saturation statistics, one row of
+    # (Sequencing Saturation, UMI detected once, UMI Types, Duplication Ratio) per entry
+    with np.errstate(divide="ignore", invalid="ignore"):
+        seq_saturation = np.where(types > 0, (1 - single / types) * 100, 0)
+        duplication_ratio = np.where(reads > 0, (reads - types) * 100 / reads, 0)
+    return np.column_stack([seq_saturation, single, types, duplication_ratio])
+
+def expected_saturation(hist, ratios, sampler="hypergeometric"):
+    # Expected number of UMIs seen once and in total when downsampling the reads-per-UMI histogram,
+    # in closed form: a UMI with k reads keeps j of them with hypergeometric (or binomial) probability
+    hist = np.asarray(hist, dtype=np.float64)
+    k = np.flatnonzero(hist[1:]) + 1
+    n_k = hist[k]
+    total = (k * n_k).sum()
+    reads, p_zero, p_one = expected_probs(k, total, ratios, sampler)
+
+    types = ((1 - p_zero) * n_k).sum(axis=1)
+    single = (p_one * n_k).sum(axis=1)
+    return [tuple(round(float(x), 2) for x in stats) for stats in saturation_stats(types, single, reads)]
+
+def gen_groups(barcodes, bc_codes, barcode2_dict, group_by):
+    # Group code of every molecule for each grouping level, FBs are named after the reference fasta
+    groups = []
+    pb_fbs = [barcode.split("_") for barcode in barcodes]
+    for level in group_by:
+        if level == "FB":
+            keys = [barcode2_dict.get(fb, fb) for _, fb in pb_fbs]
+        else:
+            keys = [pb for pb, _ in pb_fbs]
+        names, key_codes = np.unique(keys, return_inverse=True)
+        groups.append((level, names, key_codes[bc_codes]))
+    return groups
+
+def grouped_saturation(counts, groups):
+    # Saturation statistics of all groups from grouped reductions over the molecule counts,
+    # stacked over the grouping levels
+    stats = []
+    for _, names, codes in groups:
+        types = np.bincount(codes, weights=counts > 0, minlength=len(names))
+        single = np.bincount(codes, weights=counts == 1, minlength=len(names))
+        reads = np.bincount(codes, weights=counts, minlength=len(names))
+        stats.append(saturation_stats(types, single, reads))
+    return np.vstack(stats) if stats else np.empty((0, 4))
+
+def expected_grouped_saturation(counts, groups, ratios, sampler="hypergeometric"):
+    # Closed form expectation per group: the (group, reads per UMI) histogram is built once,
+    # then every ratio is a weighted bincount of the per-k probabilities
+    total = counts.sum()
+    k, k_idx = np.unique(counts, return_inverse=True)
+    reads, p_zero, p_one = expected_probs(k, total, ratios, sampler)
+    stats = []
+    for _, names, codes in groups:
+        pairs, n_pairs = np.unique(codes * len(k) + k_idx, return_counts=True)
+        pair_groups, pair_k = np.divmod(pairs, len(k))
+        group_reads = np.bincount(codes, weights=counts, minlength=len(names))
+        stats.append([saturation_stats(
+            np.bincount(pair_groups, weights=n_pairs * (1 - p_zero[i, pair_k]), minlength=len(names)),
+            np.bincount(pair_groups, weights=n_pairs * p_one[i, pair_k], minlength=len(names)),
+            group_reads * (reads[i] / total))
+            for i in range(len(ratios))])
+    return [(ratio, np.vstack([level_stats[i] for level_stats in stats])) for i, ratio in enumerate(ratios)]
+
+def grouped_table(grouped, groups, columns):
+    # Long format table with one row per grouping level, group and ratio
+    levels = np.concatenate([[level] * len(names) for level, names, _ in groups])
+    names = np.concatenate([names for _, names, _ in groups])
+    frames = []
+    for ratio, stats in grouped:
+        frame = pd.DataFrame(np.round(stats, 2), columns=columns[1:])
+        frame.insert(0, "Level", levels)
+        frame.insert(1, "Group", names)
+        frame.insert(2, columns[0], ratio)
+        frames.append(frame)
+    df = pd.concat(frames, ignore_index=True)
+    return df.sort_values(["Level", "Group", columns[0]], kind="stable", ignore_index=True)
+
+def gen_ratio_grid(n_ratios=0):
+    if n_ratios > 0:
+        return np.round(np.geomspace(0.0001, 0.9, n_ratios), 6).tolist()
+    return [round(num * i, 4) for num in [0.0001, 0.001, 0.01, 0.1] for i in range(1, 10)]
+
+def sample_curve(counts, ratios, rng, sampler="hypergeometric", mode="independent", groups=()):
+    # Saturation statistics of one downsampling replicate over the ratio grid, sorted by ratio,
+    # and the per group statistics computed from the same draws
+    if mode == "nested":
+        draws = nested_downsample(counts, ratios, rng, sampler)
+    else:
+        draws = ((ratio, downsample(counts, ratio, rng, sampler)) for ratio in ratios)
+    curve, grouped = [], []
+    for ratio, downsample_result in draws:
+        curve.append((ratio, *compute_seq_saturation(downsample_result)))
+        if groups:
+            grouped.append((ratio, grouped_saturation(downsample_result, groups)))
+    return sorted(curve, key=lambda x: x[0]), sorted(grouped, key=lambda x: x[0])
+
+def bridge_downsample(lower_counts, upper_counts, sample_size, fraction, rng, sampler="hypergeometric"):
+    # Draw a sample nested between two cached nested samples: keep the lower sample and add
+    # reads drawn from the ones only present in the upper sample
+    extra_counts = upper_counts - lower_counts
+    if sampler == "binomial":
+        return lower_counts + rng.binomial(extra_counts, fraction)
+    return lower_counts + rng.multivariate_hypergeometric(extra_counts, sample_size - int(lower_counts.sum()))
+
+def refine_nested(counts, ratios, rng, sampler="hypergeometric", steps=0, groups=()):
+    # Nested curve plus a bisection for the smallest ratio reaching the maximal saturation.
+    # Only the draws bracketing the optimum are cached and every new point is bridged between
+    # them, so the refined points stay nested with the grid and the optimum is never redrawn
+    total = int(counts.sum())
+    best = (1, counts, compute_seq_saturation(counts))
+    lower = None
+    curve, grouped = [], []
+    for ratio, downsample_result in nested_downsample(counts, ratios, rng, sampler):
+        stats = compute_seq_saturation(downsample_result)
+        curve.append((ratio, *stats))
+        if groups:
+            grouped.append((ratio, grouped_saturation(downsample_result, groups)))
+        if lower is None:
+            lower = (ratio, downsample_result, stats)
+        if stats[0] >= best[2][0]:
+            best, lower = (ratio, downsample_result, stats), None
+    if lower is None:
+        lower = (0, np.zeros_like(counts), (0, 0, 0, 0))
+
+    for _ in range(steps):
+        if int(total * best[0]) - int(total * lower[0]) <= 1:
+            break
+        ratio = round((lower[0] + best[0]) / 2, 10)
+        downsample_result = bridge_downsample(lower[1], best[1], int(total * ratio),
+                                              (ratio - lower[0]) / (best[0] - lower[0]), rng, sampler)
+        stats = compute_seq_saturation(downsample_result)
+        curve.append((ratio, *stats))
+        if groups:
+            grouped.append((ratio, grouped_saturation(downsample_result, groups)))
+        if stats[0] >= best[2][0]:
+            best = (ratio, downsample_result, stats)
+        else:
+            lower = (ratio, downsample_result, stats)
+    return sorted(curve, key=lambda x: x[0]), sorted(grouped, key=lambda x: x[0]), best[0], best[1]
+
+def refine_analytic(hist, sampling_results, sampler="hypergeometric", steps=0):
+    # Bisection on the expected curve between the first ratio reaching the maximal saturation
+    # and the ratio before it, sampling_results must be sorted and start with the zero row
+    idx = max(range(len(sampling_results)), key=lambda i: (sampling_results[i][1], -i))
+    if idx == 0:
+        return []
+    lower, best = sampling_results[idx - 1], sampling_results[idx]
+    total = int((np.arange(len(hist)) * hist).sum())
+    refined = []
+    for _ in range(steps):
+        if int(total * best[0]) - int(total * lower[0]) <= 1:
+            break
+        ratio = round((lower[0] + best[0]) / 2, 10)
+        point = (ratio, *expected_saturation(hist, [ratio], sampler)[0])
+        refined.append(point)
+        if point[1] >= best[1]:
+            best = point
+        else:
+            lower = point
+    return refined
+
+_worker_counts = None
+_worker_groups = ()
+
+def init_replicate_worker(counts, groups):
+    global _worker_counts, _worker_groups
+    _worker_counts, _worker_groups = counts, groups
+
+def replicate_worker(task):
+    seed_seq, ratios, sampler, mode = task
+    return sample_curve(_worker_counts, ratios, np.random.default_rng(seed_seq), sampler, mode, _worker_groups)
+
+def replicate_curves(counts, ratios, sampler, mode, replicates, threads, seed, ci, groups=()):
+    # Run replicates in a process pool, every replicate owns a SeedSequence child so the
+    # results do not depend on the number of workers. Group curves are averaged over replicates
+    tasks = [(seed_seq, ratios, sampler, mode) for seed_seq in np.random.SeedSequence(seed).spawn(replicates)]
+    with multiprocessing.Pool(processes=threads, initializer=init_replicate_worker, initargs=(counts, groups)) as pool:
+        results = pool.map(replicate_worker, tasks)
+    stats = np.array([curve for curve, _ in results], dtype=np.float64)[:, :, 1:]
+    grouped = []
+    if groups:
+        grouped_stats = np.mean([[group_stats for _, group_stats in replicate] for _, replicate in results], axis=0)
+        grouped = list(zip(sorted(ratios), grouped_stats))
+    lower, upper = (100 - ci) / 2, 100 - (100 - ci) / 2
+    return (stats.mean(axis=0).round(2), grouped,
+            (lower, np.percentile(stats, lower, axis=0).round(2)),
+            (upper, np.percentile(stats, upper, axis=0).round(2)))
+
 if __name__ == "__main__":
     args = setup_and_parse_args()
     sample = args.sample
     input_dir = args.input_dir
     output_dir = args.output_dir
     config = read_json_config(args.config)
+    sampler = args.sampler
+    rng = np.random.default_rng(args.seed)
 
     barcode2_ref, per_barcode1_len = parse_json_config(config)
 
@@ -91,28 +333,70 @@ if __name__ == "__main__":
     with open(file, "r") as f:
             dict_b = json.load(f)
 
+    barcodes, bc_codes, umis, counts = dict2arrays(dict_b)
+    del dict_b
+    # the reads-per-UMI histogram comes from the count_UMI.py sidecar when available
+    umi_hist_file = f"{input_dir}/{sample}_UMI_hist.tsv"
+    hist = read_umi_hist(umi_hist_file) if os.path.exists(umi_hist_file) else np.bincount(counts)
+    barcode2_dict = fa2dict(barcode2_ref)
+    groups = gen_groups(barcodes, bc_codes, barcode2_dict, args.group_by)
+    if sampler == "hypergeometric" and counts.sum() >= MAX_HYPERGEOMETRIC_READS:
+        log_info(f"Step 6. {counts.sum()} reads exceed the hypergeometric sampler limit, use binomial thinning instead")
+        sampler = "binomial"
+
     # Calculate saturation after downsampling with different ratio
+    ratios = gen_ratio_grid(args.n_ratios)
+    bands = []
+    grouped = []
+    optimal_counts = None
     sampling_results = [(0, 0, 0, 0, 0)] 
-    for num in [0.0001, 0.001, 0.01, 0.1]:
-        for i in range(1, 10):
-            downsample_ratio = round(num * i, 4)
-            downsample_result = downsample(dict_b, downsample_ratio)
-            stats = compute_seq_saturation(downsample_result)
+    if args.refine_steps > 0 and (args.mode == "independent" or args.replicates > 1):
+        log_info("Step 6. Ratio refinement needs a single nested or analytic curve, skip it")
+    if args.mode == "analytic":
+        for downsample_ratio, stats in zip(ratios, expected_saturation(hist, ratios, sampler)):
             sampling_results.append((downsample_ratio, stats[0], stats[1], stats[2], stats[3]))
+        if groups:
+            grouped = expected_grouped_saturation(counts, groups, ratios, sampler)
+    elif args.replicates > 1:
+        log_info(f"Step 6. Run {args.replicates} downsampling replicates with {args.threads} processes")
+        mean_stats, grouped, *bands = replicate_curves(counts, ratios, sampler, args.mode, args.replicates,
+                                                       args.threads, args.seed, args.ci, groups)
+        for downsample_ratio, stats in zip(ratios, mean_stats.tolist()):
+            sampling_results.append((downsample_ratio, stats[0], stats[1], stats[2], stats[3]))
+    elif args.mode == "nested" and args.refine_steps > 0:
+        curve, grouped, optimal_ratio, optimal_counts = refine_nested(counts, ratios, rng, sampler, args.refine_steps, groups)
+        sampling_results.extend(curve)
+    else:
+        curve, grouped = sample_curve(counts, ratios, rng, sampler, args.mode, groups)
+        sampling_results.extend(curve)
 
     # Calculate saturation without downsampling
-    stats = compute_seq_saturation(dict_b)
+    stats = hist_saturation(hist)
     sampling_results.append((1, stats[0], stats[1], stats[2], stats[3]))
-    df = pd.DataFrame(sampling_results, columns=['Downsample Ratio', 'Sequencing Saturation', "UMI detected once", "UMI Types", 'Duplication Ratio'])
+    if args.mode == "analytic" and args.refine_steps > 0:
+        sampling_results.extend(refine_analytic(hist, sampling_results, sampler, args.refine_steps))
+        sampling_results.sort(key=lambda x: x[0])
+    columns = ['Downsample Ratio', 'Sequencing Saturation', "UMI detected once", "UMI Types", 'Duplication Ratio']
+    df = pd.DataFrame(sampling_results, columns=columns)
+    # Percentile bands over replicates, the first and last rows are exact
+    for percentile, band_stats in bands:
+        band_stats = np.vstack([np.zeros(4), band_stats, stats])
+        for col, values in zip(columns[1:], band_stats.T):
+            df[f"{col} P{percentile:g}"] = values
     df.to_csv(f"{output_dir}/{sample}_Downsample.tsv", sep="\t")
+    if groups:
+        grouped.append((1, grouped_saturation(counts, groups)))
+        grouped_table(grouped, groups, columns).to_csv(f"{output_dir}/{sample}_Downsample_grouped.tsv", sep="\t", index=False)
 
     # Get the optimal ratio of sampling results and generate the final result
-    optimal_ratio = df.loc[df['Sequencing Saturation'].idxmax(), 'Downsample Ratio']
-    downsample_result = downsample(dict_b, optimal_ratio)
+    # (the refined nested search already holds the draw at its optimum)
+    if optimal_counts is None:
+        optimal_ratio = df.loc[df['Sequencing Saturation'].idxmax(), 'Downsample Ratio']
+        optimal_counts = downsample(counts, optimal_ratio, rng, sampler)
+    downsample_result = arrays2dict(barcodes, bc_codes, umis, optimal_counts)
     downsample_result_path = f"{output_dir}/{sample}_dic_after_downsample.json"
     with open(downsample_result_path, 'w') as file:
             json.dump(downsample_result, file, indent=4)
 
-    barcode2_dict = fa2dict(barcode2_ref)
     per_bc_umi_count_after_downsample = get_bc_umi_counts(downsample_result)
-    write_dict_to_tsv(per_bc_umi_count_after_downsample, f"{output_dir}/{sample}_per_bc_umi_count_after_downsample.map", per_barcode1_len, barcode2_dict)
\ No newline at end of file
+    write_dict_to_tsv(per_bc_umi_count_after_downsample, f"{output_dir}/{sample}_per_bc_umi_count_after_downsample.map", per_barcode1_len, barcode2_dict)
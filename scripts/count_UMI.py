@@ -3,8 +3,9 @@
 import os
 import json
 from copy import deepcopy
+from collections import Counter, defaultdict
 import argparse
-from utils import read_json_config, read_fq, fa2dict, get_bc_umi_counts, write_dict_to_tsv, log_info
+from utils import read_json_config, read_fq, fa2dict, get_bc_umi_counts, write_dict_to_tsv, write_umi_hist, log_info
 from umi_tools.network import UMIClusterer
 
 def setup_and_parse_args():
@@ -99,6 +100,8 @@ def get_pibc_new_umis_with_umitools(dic_A):
     log_info("Step 5. Correcting UMIs using UMI-tools...")
     dic_B = {}
     correct_list = {}
+    # reads-per-UMI histograms per FB, collected while correcting
+    umi_hists = {"before_correct": defaultdict(Counter), "after_correct": defaultdict(Counter)}
 
     n = 0
     dic_A_len = len(dic_A)
@@ -139,22 +142,28 @@ def get_pibc_new_umis_with_umitools(dic_A):
         if umi_correct_mapping:
             correct_list[bc] = umi_correct_mapping
 
-    return dic_B, correct_list
+        fb = bc.split("_")[1]
+        umi_hists["before_correct"][fb].update(umi_counts.values())
+        umi_hists["after_correct"][fb].update(umi_count_new.values())
+
+    return dic_B, correct_list, umi_hists
 
 def export_nested_dict_to_json(nested_dict, file_name):
     with open(file_name, 'w') as file:
         json.dump(nested_dict, file, indent=4)
 
-def output_results(per_barcode1_len, barcode2_dict, dic_A, dic_B, correct_list, per_bc_umi_count_a_correct, per_bc_umi_count_b_correct, total_reads, dir, prefix):
+def output_results(per_barcode1_len, barcode2_dict, dic_A, dic_B, correct_list, umi_hists, per_bc_umi_count_a_correct, per_bc_umi_count_b_correct, total_reads, dir, prefix):
     '''step 4'''
     dic_A_out = os.path.join(dir, f"{prefix}_dic_A.json")
     dic_B_out = os.path.join(dir, f"{prefix}_dic_B.json")
+    umi_hist_out = os.path.join(dir, f"{prefix}_UMI_hist.tsv")
     per_bc_umi_count_a_correct_out = os.path.join(dir, f"{prefix}_per_bc_umi_count_after_correct.map")
     per_bc_umi_count_b_correct_out = os.path.join(dir, f"{prefix}_per_bc_umi_count_before_correct.map")
     log_out = os.path.join(dir, f"{prefix}_correct_umi.log")
 
     export_nested_dict_to_json(dic_A, dic_A_out)
     export_nested_dict_to_json(dic_B, dic_B_out)
+    write_umi_hist(umi_hists, umi_hist_out, barcode2_dict)
 
     correct_list_new = deepcopy(correct_list)
     for key, value in correct_list_new.items():
@@ -187,7 +196,7 @@ if __name__ == "__main__":
     r2 = os.path.join(input_dir, f"{sample}_r2.fq.gz")
     total_reads, dic_A = get_pibc_raw_umis(r1, r2, barcode_start, barcode_end, umi_start, umi_end)
     
-    dic_B, correct_list = get_pibc_new_umis_with_umitools(dic_A)
+    dic_B, correct_list, umi_hists = get_pibc_new_umis_with_umitools(dic_A)
     per_bc_umi_count_a_correct = get_bc_umi_counts(dic_B)
     per_bc_umi_count_b_correct = get_bc_umi_counts(dic_A)
-    output_results(per_barcode1_len, barcode2_dict, dic_A, dic_B, correct_list, per_bc_umi_count_a_correct, per_bc_umi_count_b_correct, total_reads, out_dir, sample)
\ No newline at end of file
+    output_results(per_barcode1_len, barcode2_dict, dic_A, dic_B, correct_list, umi_hists, per_bc_umi_count_a_correct, per_bc_umi_count_b_correct, total_reads, out_dir, sample)
\ No newline at end of file
@@ -1,54 +1,230 @@
 #! /usr/bin/env python
 
-import pandas as pd
+import os
+import json
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
+import pandas as pd
+from scipy.interpolate import pade
+from scipy.optimize import brentq
 import argparse
+import zlib
+from utils import read_umi_hist, log_info
 
 
 def setup_and_parse_args():
-    parser = argparse.ArgumentParser(description="Saturation Correction.")
-    parser.add_argument("-s", "--sample", required=True, help="sample name")
-    parser.add_argument("-i", "--input_dir", required=True, help="Path to the input path")
+    parser = argparse.ArgumentParser(description="Estimate library complexity.")
+    parser.add_argument("-s", "--samples", required=True, help="sample names")
     parser.add_argument("-o", "--output_dir", required=True, help="Path to the output path")
+    parser.add_argument("-r", "--ratios", default="0.25,0.5,1,2,5,10,20,50,100",
+                        help="comma separated sequencing depths to predict, relative to the current depth")
+    parser.add_argument("-t", "--target_saturation", type=float, default=90, help="target sequencing saturation in percent")
+    parser.add_argument("-b", "--bootstraps", type=int, default=100, help="number of bootstrap replicates for the confidence interval")
+    parser.add_argument("--ci", type=float, default=95, help="width of the bootstrap confidence interval, in percent")
+    parser.add_argument("--max_degree", type=int, default=8, help="maximal degree of the rational function")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--plot", action="store_true", help="save the extrapolation curve as pdf")
     args = parser.parse_args()
     return args
 
-if __name__ == "__main__":
-    args = setup_and_parse_args()
-    input_dir = args.input_dir
-    output_dir = args.output_dir
-    sample = args.sample
+def get_umi_hist(counts_dir, sample):
+    # Reads-per-UMI histogram, hist[k] is the number of UMIs supported by k reads. It is read from
+    # the sidecar written by count_UMI.py, the molecule json is only loaded for older runs
+    umi_hist_file = os.path.join(counts_dir, f"{sample}_UMI_hist.tsv")
+    if os.path.exists(umi_hist_file):
+        return read_umi_hist(umi_hist_file)
+    dic_B_file = os.path.join(counts_dir, f"{sample}_dic_B.json")
+    with open(dic_B_file, "r") as f:
+        dic_B = json.load(f)
+    counts = np.fromiter((count for umi_counts in dic_B.values() for count in umi_counts.values()), dtype=np.int64)
+    return np.bincount(counts)
+
+def fit_rational(hist, max_degree=8, max_ratio=100):
+    # preseq-style extrapolation: the Good-Toulmin series of new UMIs at relative depth 1+t,
+    # sum((-1)^(j+1) * n_j * t^j), is replaced by its diagonal Pade approximant. The degree is
+    # lowered until the approximant is finite and increasing with no pole on t > 0, and the
+    # predicted saturation does not fall anywhere in [1, max_ratio]
+    hist = np.asarray(hist, dtype=np.float64)
+    n_obs = hist[1:].sum()
+    coefs = np.zeros(2 * max_degree + 1)
+    n_terms = min(len(hist), len(coefs))
+    coefs[1:n_terms] = hist[1:n_terms] * (-1.0) ** np.arange(2, n_terms + 1)
+    t = np.linspace(0, max_ratio - 1, 500)
+
+    for degree in range(max_degree, 0, -1):
+        if degree > 1 and not np.any(coefs[degree + 1:2 * degree + 1]):
+            continue
+        try:
+            p, q = pade(coefs[:2 * degree + 1], degree, degree)
+        except (np.linalg.LinAlgError, ValueError):
+            continue
+        if not np.isfinite(p.coeffs).all() or not np.isfinite(q.coeffs).all() or q.coeffs[0] == 0:
+            continue
+        roots = q.roots
+        if np.any((np.abs(roots.imag) < 1e-8) & (roots.real > 0)):
+            continue
+        with np.errstate(all="ignore"):
+            new_umis = p(t) / q(t)
+        if not np.isfinite(new_umis).all() or np.any(np.diff(new_umis) < -1e-6 * max(new_umis[-1], 1)):
+            continue
+        if p.coeffs[0] / q.coeffs[0] <= 0:
+            continue
+        with np.errstate(all="ignore"):
+            saturation = 1 - (1 + t) * (p.deriv()(t) * q(t) - p(t) * q.deriv()(t)) / q(t) ** 2 / (n_obs + new_umis)
+        if not np.isfinite(saturation).all() or np.any(np.diff(saturation) < -1e-6):
+            continue
+        return p, q
+    return None
+
+def chao_unseen(hist):
+    # Bias-corrected Chao1 estimate of the UMIs not observed yet
+    f1 = hist[1] if len(hist) > 1 else 0
+    f2 = hist[2] if len(hist) > 2 else 0
+    return f1 * (f1 - 1) / (2 * (f2 + 1))
+
+def predict_curve(hist, model, ratios):
+    # Expected UMI types and singletons at each relative depth: exact binomial expectation
+    # when downsampling (ratio <= 1), rational extrapolation beyond the current depth.
+    # Under Poisson sampling the singletons are ratio * d(UMI types)/d(ratio). Without a valid
+    # fit the new UMIs approach the Chao1 asymptote as f0 * (1 - exp(-t * f1 / f0)), which keeps
+    # the observed singletons at t = 0; the curve is flat when nothing is left unseen
+    hist = np.asarray(hist, dtype=np.float64)
+    ratios = np.asarray(ratios, dtype=np.float64)
+    k = np.arange(len(hist))
+    n_obs = hist[1:].sum()
+    types = np.full(len(ratios), np.nan)
+    singles = np.full(len(ratios), np.nan)
+
+    inner = ratios <= 1
+    r = ratios[inner][:, None]
+    types[inner] = ((1 - np.power(1 - r, k)) * hist)[:, 1:].sum(axis=1)
+    singles[inner] = (k * r * np.power(1 - r, np.maximum(k - 1, 0)) * hist)[:, 1:].sum(axis=1)
 
-    df = pd.read_csv(f"{input_dir}/{sample}_Downsample.tsv", sep='\t')
-    x = df["Downsample Ratio"].values
-    y = df["UMI Types"].values
+    if model is not None:
+        p, q = model
+        t = ratios[~inner] - 1
+        types[~inner] = n_obs + p(t) / q(t)
+        singles[~inner] = ratios[~inner] * (p.deriv()(t) * q(t) - p(t) * q.deriv()(t)) / q(t) ** 2
+    else:
+        t = ratios[~inner] - 1
+        f0, f1 = chao_unseen(hist), (hist[1] if len(hist) > 1 else 0)
+        decay = np.exp(-t * f1 / f0) if f0 > 0 else np.ones(len(t))
+        types[~inner] = n_obs + f0 * (1 - decay)
+        singles[~inner] = ratios[~inner] * f1 * decay if f0 > 0 else 0
+    return types, singles
 
-    # 定义Michaelis-Menten模型
-    def michaelis_menten(x, Vmax, K):
-        return (Vmax * x) / (K + x)
+def library_size(hist, model):
+    # Asymptote of the rational function, or the bias-corrected Chao1 bound without a valid fit
+    hist = np.asarray(hist, dtype=np.float64)
+    n_obs = hist[1:].sum()
+    if model is not None:
+        p, q = model
+        return n_obs + p.coeffs[0] / q.coeffs[0]
+    return n_obs + chao_unseen(hist)
 
-    popt, _ = curve_fit(michaelis_menten, x, y, bounds=(0, np.inf))
-    Vmax, K = popt
+def saturation_at(hist, model, ratio):
+    types, singles = predict_curve(hist, model, [ratio])
+    return (1 - singles[0] / types[0]) * 100 if types[0] > 0 else 0
 
-    # 绘图
-    x_fit = np.linspace(0, 5.0, 200)
-    y_fit = michaelis_menten(x_fit, *popt)
+def ratio_for_saturation(hist, model, target, max_ratio=100):
+    # Relative depth needed to reach the target saturation, nan if it is not reached within
+    # the depths the model was checked on
+    current = saturation_at(hist, model, 1)
+    if current >= target:
+        low, high = 1e-6, 1
+    else:
+        low, high = 1, max_ratio
+    f = lambda ratio: saturation_at(hist, model, ratio) - target
+    if not np.isfinite(f(high)) or f(low) * f(high) > 0:
+        return np.nan
+    return brentq(f, low, high, xtol=1e-6)
+
+def estimate_complexity(hist, ratios, target, n_boot=100, ci=95, max_degree=8, rng=None):
+    # Point estimates plus bootstrap intervals. Bootstrap histograms are drawn at once by
+    # resampling the observed UMIs multinomially over the histogram bins
+    rng = rng if rng is not None else np.random.default_rng()
+    hist = np.asarray(hist, dtype=np.int64)
+    max_ratio = max(max(ratios), 2)
+    model = fit_rational(hist, max_degree, max_ratio)
+    types, singles = predict_curve(hist, model, ratios)
+
+    n_obs = int(hist[1:].sum())
+    boot_hists = np.zeros((n_boot, len(hist)), dtype=np.int64)
+    if n_obs > 0:
+        boot_hists[:, 1:] = rng.multinomial(n_obs, hist[1:] / n_obs, size=n_boot)
+    boot_types = np.full((n_boot, len(ratios)), np.nan)
+    boot_sizes = np.full(n_boot, np.nan)
+    for i, boot_hist in enumerate(boot_hists):
+        boot_model = fit_rational(boot_hist, max_degree, max_ratio)
+        boot_types[i] = predict_curve(boot_hist, boot_model, ratios)[0]
+        boot_sizes[i] = library_size(boot_hist, boot_model)
+
+    lower, upper = (100 - ci) / 2, 100 - (100 - ci) / 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        saturation = np.where(types > 0, (1 - singles / types) * 100, 0)
+        types_lower, types_upper = np.nanpercentile(boot_types, [lower, upper], axis=0)
+        size_lower, size_upper = np.nanpercentile(boot_sizes, [lower, upper])
+    target_ratio = ratio_for_saturation(hist, model, target, max_ratio)
+
+    summary = pd.DataFrame([{
+        "Vmax": library_size(hist, model),
+        "Vmax_lower": size_lower,
+        "Vmax_upper": size_upper,
+        "Observed": n_obs,
+        "Saturation": saturation_at(hist, model, 1),
+        "Target_Saturation": target,
+        "Target_Ratio": target_ratio,
+        "Target_Reads": target_ratio * int((np.arange(len(hist)) * hist).sum()),
+        "Degree": len(model[1].coeffs) - 1 if model is not None else 0,
+    }])
+    curve = pd.DataFrame({
+        "Depth Ratio": ratios,
+        "UMI Types": types,
+        f"UMI Types P{lower:g}": types_lower,
+        f"UMI Types P{upper:g}": types_upper,
+        "Sequencing Saturation": saturation,
+    })
+    return summary, curve
+
+def plot_curve(summary, curve, sample, file):
+    import matplotlib.pyplot as plt
+
+    x = curve["Depth Ratio"]
+    band_cols = [col for col in curve.columns if col.startswith("UMI Types P")]
+    vmax = summary["Vmax"].iloc[0]
 
     plt.figure(figsize=(10, 6))
-    plt.scatter(x, y, label="Observed Data", color="blue")
-    plt.plot(x_fit, y_fit, label=f"Michaelis-Menten Fit\n$V_{{max}}$ = {Vmax:.0f}, K = {K:.4f}", color="red")
-    plt.axhline(Vmax, color='gray', linestyle='--', label=f"$V_{{max}}$ ≈ {Vmax:.0f}")
-    plt.xlabel("Downsample Ratio")
+    plt.plot(x, curve["UMI Types"], label="Expected UMI Types", color="red")
+    plt.fill_between(x, curve[band_cols[0]], curve[band_cols[1]], color="red", alpha=0.2, label="Bootstrap CI")
+    plt.axvline(1, color="blue", linestyle=":", label="Current depth")
+    plt.axhline(vmax, color='gray', linestyle='--', label=f"$V_{{max}}$ ≈ {vmax:.0f}")
+    plt.xscale("log")
+    plt.xlabel("Relative Sequencing Depth")
     plt.ylabel("UMI Types")
-    plt.title("UMI Types Saturation Prediction (Michaelis-Menten Fit)")
+    plt.title(f"{sample} Library Complexity Extrapolation")
     plt.legend()
     plt.grid(False)
     plt.tight_layout()
-    plt.savefig(f"{output_dir}/{sample}_Estimation.pdf", bbox_inches="tight")
-
-    with open(f"{output_dir}/{sample}_Estimation.tsv", "w") as f:
-        f.write(f"Vmax\tK\n{Vmax}\t{K}")
+    plt.savefig(file, bbox_inches="tight")
+    plt.close()
 
+if __name__ == "__main__":
+    args = setup_and_parse_args()
+    output_dir = args.output_dir
+    ratios = sorted(float(ratio) for ratio in args.ratios.split(","))
+    # a dense grid for the curve, plus the requested depths
+    curve_ratios = np.unique(np.concatenate([np.geomspace(0.01, max(ratios), 100), ratios]))
+    for sample in args.samples.split():
+        counts_dir = os.path.join(output_dir, sample, "03_counts")
+        saturation_dir = os.path.join(output_dir, sample, "04_saturation")
+        hist = get_umi_hist(counts_dir, sample)
+        # Seeded per sample, the bootstrap does not depend on the other samples of the batch
+        rng = np.random.default_rng(np.random.SeedSequence([args.seed, zlib.crc32(sample.encode())]))
 
+        summary, curve = estimate_complexity(hist, curve_ratios, args.target_saturation,
+                                             args.bootstraps, args.ci, args.max_degree, rng)
+        summary.to_csv(os.path.join(saturation_dir, f"{sample}_Estimation.tsv"), sep="\t", index=False)
+        curve[curve["Depth Ratio"].isin(ratios)].to_csv(
+            os.path.join(saturation_dir, f"{sample}_Estimation_curve.tsv"), sep="\t", index=False)
+        if args.plot:
+            plot_curve(summary, curve, sample, os.path.join(saturation_dir, f"{sample}_Estimation.pdf"))
+        log_info(f"Step 7. Library size of {sample} is estimated as {summary['Vmax'].iloc[0]:.0f}")
@@ -6,21 +6,68 @@ from joblib import Parallel, delayed
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
-from numba import njit
+from scipy import sparse as sp
+from numba import njit, prange, set_num_threads, config as numba_config
 from typing import Dict, List
 import logging
+import json
+import glob
+import hashlib
 import argparse
 
 from statsmodels.stats.multitest import fdrcorrection 
+from utils import permutation_matrix
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
 def setup_and_parse_args():
     parser = argparse.ArgumentParser(description="Barcode Validation.")
-    parser.add_argument("-s", "--samples", required=True, help="sample name")
+    parser.add_argument("-s", "--samples", default="", help="sample name")
     parser.add_argument("-o", "--output", required=True, help="Path to the output path")
     parser.add_argument("-c", "--config", required=True, help="Path to the config json")
+    parser.add_argument("-n", "--n_permutations", type=int, default=1000,
+                        help="number of permutations, the maximum per pair with --adaptive")
+    parser.add_argument("--adaptive", type=int, default=0, metavar="H",
+                        help="Besag-Clifford sequential stopping: stop sampling a pair once both its >= and <= exceedance counts reach H, 0 to disable")
+    parser.add_argument("--schedule", default="shared", choices=["shared", "sample"],
+                        help="shared: the (sample, block) units of all samples share one pool, largest first. With --engine numba it is a thread "
+                             "pool running the compiled block kernel without the GIL; with --engine joblib a process pool. "
+                             "sample: one sample after another. --adaptive always runs sample by sample")
+    parser.add_argument("--engine", default="numba", choices=["numba", "joblib"],
+                        help="numba runs the compiled blocks in one process (prange threads per sample, or the shared thread pool), "
+                             "joblib runs one process task per block")
+    parser.add_argument("--dense", action="store_true",
+                        help="dense null model: expand the PB x feature matrix and recount co-occurrence per permutation, "
+                             "instead of the default per-row bitsets with incremental updates (same results, memory grows with n_PB x n_features)")
+    parser.add_argument("--model", default="swap", choices=["swap", "curveball"],
+                        help="null model: edge swaps (num_edges * edges_times per permutation) or curveball row-pair trades (n_rows * edges_times)")
+    parser.add_argument("--thin", type=int, default=0,
+                        help="chained sampling: burn in once per block, then take a permutation every THIN sweeps (one sweep = num_edges swaps or n_rows trades); 0 restarts every permutation from the observed matrix")
+    parser.add_argument("--seed", type=int, default=42, help="root seed, permutation seeds are derived with SeedSequence")
+    parser.add_argument("--shard", default=None, metavar="i/N",
+                        help="run only the i-th of N shards of the permutation blocks (1-based) and write its accumulator states")
+    parser.add_argument("--no_cache", action="store_true",
+                        help="recompute every sample instead of reusing Permutation/cache results of unchanged samples")
+    parser.add_argument("--pairs", default=None,
+                        help="tsv of feature pairs (two columns, no header) to test instead of the full matrix")
+    parser.add_argument("--subset", default=None,
+                        help="comma separated features tested against all features instead of the full matrix")
+    parser.add_argument("--top_k", type=int, default=0, help="only keep the K pairs with the largest |z| per sample in Permutation.parquet, 0 keeps all pairs")
+    parser.add_argument("--excel", action="store_true",
+                        help="also export one Permutation_{metric}.xlsx per metric (one sheet per sample) from Permutation.parquet")
+    parser.add_argument("--merge", action="store_true", help="merge the shard files of the Permutation directory into the outputs")
     args = parser.parse_args()
+    if args.shard and args.adaptive > 0:
+        parser.error("--shard does not support --adaptive")
+    if args.shard:
+        try:
+            shard, n_shards = map(int, args.shard.split("/"))
+        except ValueError:
+            parser.error(f"--shard must be i/N, got {args.shard}")
+        if not 1 <= shard <= n_shards:
+            parser.error(f"--shard i/N requires 1 <= i <= N, got {args.shard}")
+    if not args.merge and not args.samples:
+        parser.error("-s/--samples is required unless --merge")
     return args
 
 def load_single_df(sample, output_dir):
@@ -29,21 +76,48 @@ def load_single_df(sample, output_dir):
     return sample, df
 
 @njit(cache=True)
-def compute_single_permutation_swap(M_binary: np.ndarray, edges_times: int = 5, seed: int = 0) -> np.ndarray:
+def has_edge(M_rand: np.ndarray, bits: np.ndarray, r: int, c: int) -> bool:
+    # 稀疏模式 (bits 非空) 查每行的位图，否则查稠密矩阵
+    if bits.shape[0] > 0:
+        return (bits[r, c >> 6] >> np.uint64(c & 63)) & np.uint64(1) != 0
+    return M_rand[r, c] != 0
 
-    if seed != 0:
-        np.random.seed(seed)
-        
-    M_rand = M_binary.copy()
-    row_indices, col_indices = np.where(M_rand == 1)
+@njit(cache=True)
+def set_edge(M_rand: np.ndarray, bits: np.ndarray, r: int, c: int, value: int) -> None:
+    if bits.shape[0] > 0:
+        mask = np.uint64(1) << np.uint64(c & 63)
+        if value:
+            bits[r, c >> 6] |= mask
+        else:
+            bits[r, c >> 6] &= ~mask
+    else:
+        M_rand[r, c] = value
+
+@njit(cache=True)
+def move_row_edge(row_ptr, col_indices, cooc, r, idx, c_old, c_new):
+    # 行 r 的边 idx 从 c_old 移到 c_new：只更新该行其它列与这两列的共现，O(deg)
+    for e in range(row_ptr[r], row_ptr[r + 1]):
+        if e == idx:
+            continue
+        c = col_indices[e]
+        cooc[c_old, c] -= 1
+        cooc[c, c_old] -= 1
+        cooc[c_new, c] += 1
+        cooc[c, c_new] += 1
+    cooc[c_old, c_old] -= 1
+    cooc[c_new, c_new] += 1
+
+@njit(cache=True)
+def swap_steps(M_rand, bits, row_ptr, row_indices, col_indices, cooc, n_steps):
+    # 边交换：随机取两条边 (r1, c1), (r2, c2)，交换为 (r1, c2), (r2, c1)。
+    # 稀疏模式下共现矩阵 cooc 随每次交换增量更新
     num_edges = len(row_indices)
-    
+
     if num_edges < 2:
-        return M_rand.T @ M_rand
-        
-    num_swaps = num_edges * edges_times 
-    
-    for _ in range(num_swaps):
+        return
+
+    track = bits.shape[0] > 0
+    for _ in range(n_steps):
         idx1 = np.random.randint(0, num_edges)
         idx2 = np.random.randint(0, num_edges)
         
@@ -53,23 +127,340 @@ def compute_single_permutation_swap(M_binary: np.ndarray, edges_times: int = 5,
         r1, c1 = row_indices[idx1], col_indices[idx1]
         r2, c2 = row_indices[idx2], col_indices[idx2]
         
-        if (r1 != r2) and (c1 != c2) and (M_rand[r1, c2] == 0) and (M_rand[r2, c1] == 0):
-            M_rand[r1, c1], M_rand[r2, c2] = 0, 0
-            M_rand[r1, c2], M_rand[r2, c1] = 1, 1
+        if (r1 != r2) and (c1 != c2) and not has_edge(M_rand, bits, r1, c2) and not has_edge(M_rand, bits, r2, c1):
+            if track:
+                move_row_edge(row_ptr, col_indices, cooc, r1, idx1, c1, c2)
+                move_row_edge(row_ptr, col_indices, cooc, r2, idx2, c2, c1)
+            set_edge(M_rand, bits, r1, c1, 0)
+            set_edge(M_rand, bits, r2, c2, 0)
+            set_edge(M_rand, bits, r1, c2, 1)
+            set_edge(M_rand, bits, r2, c1, 1)
             col_indices[idx1], col_indices[idx2] = c2, c1
 
-    return M_rand.T @ M_rand
+@njit(cache=True)
+def curveball_steps(M_rand, bits, row_ptr, row_indices, col_indices, cooc, n_steps, slots, pool):
+    # Curveball：随机取两行，把两行各自独有的列混在一起重新分配（保持各行列数），
+    # 一次交易相当于多次边交换，且每次交易都有效
+    n_rows = len(row_ptr) - 1
+
+    if n_rows < 2:
+        return
+
+    track = bits.shape[0] > 0
+    for _ in range(n_steps):
+        r1 = np.random.randint(0, n_rows)
+        r2 = np.random.randint(0, n_rows)
+
+        if r1 == r2:
+            continue
+
+        n1 = 0
+        for e in range(row_ptr[r1], row_ptr[r1 + 1]):
+            if not has_edge(M_rand, bits, r2, col_indices[e]):
+                slots[n1], pool[n1] = e, col_indices[e]
+                n1 += 1
+        n = n1
+        for e in range(row_ptr[r2], row_ptr[r2 + 1]):
+            if not has_edge(M_rand, bits, r1, col_indices[e]):
+                slots[n], pool[n] = e, col_indices[e]
+                n += 1
+
+        if n1 == 0 or n1 == n:
+            continue
+
+        for i in range(n - 1, 0, -1):
+            j = np.random.randint(0, i + 1)
+            pool[i], pool[j] = pool[j], pool[i]
+
+        # 先清除旧列再写入新列，同一行内的列可能互换位置
+        for i in range(n):
+            set_edge(M_rand, bits, r1 if i < n1 else r2, col_indices[slots[i]], 0)
+        for i in range(n):
+            r, e = (r1 if i < n1 else r2), slots[i]
+            if track:
+                move_row_edge(row_ptr, col_indices, cooc, r, e, col_indices[e], pool[i])
+            col_indices[e] = pool[i]
+            set_edge(M_rand, bits, r, pool[i], 1)
+
+@njit(cache=True)
+def cooccurrence_from_edges(row_indices: np.ndarray, col_indices: np.ndarray, out: np.ndarray) -> None:
+    # 边按行连续排列（np.where 行优先顺序），共现矩阵 = 每行内列两两计数，等价于 M.T @ M
+    out[:] = 0
+    num_edges = len(row_indices)
+    start = 0
+    while start < num_edges:
+        end = start
+        while end < num_edges and row_indices[end] == row_indices[start]:
+            end += 1
+        for i in range(start, end):
+            for j in range(start, end):
+                out[col_indices[i], col_indices[j]] += 1
+        start = end
+
+@njit(nogil=True, cache=True)
+def run_permutation_block(graph, real_vals, targets, edges_times, seeds, curveball, thin, mean, m2, n_ge, n_le):
+    # 一个块内的置换依次执行，共现矩阵中 targets（展平下标）的值原位累加到 mean / M2 / 超越计数，
+    # 与 NullAccumulator.update 一致。全矩阵模式下 targets 为 0..n_cols^2-1
+    # graph = (M_binary, bits, row_ptr, row_indices, col_indices)，稀疏模式下 M_binary 为空，否则 bits 为空。
+    # thin == 0: 每次置换都从观测矩阵重新开始；thin > 0: 块内一条马尔可夫链，块首 burn-in 一次后每 thin 轮取一个样本
+    # （一轮 = num_edges 次交换或 n_rows 次交易，与 burn-in 的 edges_times 轮同一单位）
+    M_binary, bits, row_ptr, row_indices, col_indices = graph
+    sparse = bits.shape[0] > 0
+    n_rows = len(row_ptr) - 1
+    n_cols = real_vals.shape[0]
+    sweep = n_rows if curveball else len(row_indices)
+    n_steps = sweep * edges_times
+    max_degree = np.max(np.diff(row_ptr)) if n_rows > 0 else 0
+    slots = np.empty(2 * max_degree, dtype=np.int64)
+    pool = np.empty(2 * max_degree, dtype=col_indices.dtype)
+    M_rand = np.empty_like(M_binary)
+    bits_rand = np.empty_like(bits)
+    cols = np.empty_like(col_indices)
+    rand_vals = np.zeros((n_cols, n_cols), dtype=np.float64)
+    count = 0
+    for i in range(len(seeds)):
+        steps = thin * sweep
+        if thin == 0 or i == 0:
+            cols[:] = col_indices
+            M_rand[:] = M_binary
+            bits_rand[:] = bits
+            rand_vals[:] = real_vals
+            if seeds[i] != 0:
+                np.random.seed(seeds[i])
+            steps = n_steps
+        if curveball:
+            curveball_steps(M_rand, bits_rand, row_ptr, row_indices, cols, rand_vals, steps, slots, pool)
+        else:
+            swap_steps(M_rand, bits_rand, row_ptr, row_indices, cols, rand_vals, steps)
+        if not sparse:
+            cooccurrence_from_edges(row_indices, cols, rand_vals)
+        count += 1
+        rand_flat = rand_vals.reshape(-1)
+        real_flat = real_vals.reshape(-1)
+        for t in range(len(targets)):
+            k = targets[t]
+            x = rand_flat[k]
+            delta = x - mean[t]
+            mean[t] += delta / count
+            m2[t] += delta * (x - mean[t])
+            if x >= real_flat[k]:
+                n_ge[t] += 1
+            if x <= real_flat[k]:
+                n_le[t] += 1
+    return count
+
+@njit(parallel=True, cache=True)
+def permutation_blocks_kernel(graph, real_vals, targets, edges_times, seeds, block_size, curveball, thin):
+    # 每个线程处理若干块，共享同一份边列表，每块的累加状态写入各自的切片
+    n_targets = len(targets)
+    n_blocks = (len(seeds) + block_size - 1) // block_size
+    means = np.zeros((n_blocks, n_targets), dtype=np.float64)
+    m2s = np.zeros((n_blocks, n_targets), dtype=np.float64)
+    n_ges = np.zeros((n_blocks, n_targets), dtype=np.int64)
+    n_les = np.zeros((n_blocks, n_targets), dtype=np.int64)
+    counts = np.zeros(n_blocks, dtype=np.int64)
+    for b in prange(n_blocks):
+        block_seeds = seeds[b * block_size:min((b + 1) * block_size, len(seeds))]
+        counts[b] = run_permutation_block(graph, real_vals, targets, edges_times, block_seeds, curveball, thin,
+                                          means[b], m2s[b], n_ges[b], n_les[b])
+    return counts, means, m2s, n_ges, n_les
+
+class NullAccumulator:
+    """置换共现矩阵的流式统计量。
+
+    Welford 累加 mean / M2（得到 mean_rand 与 std_rand），并统计相对观测矩阵的超越次数
+    （得到 p_val_enrich / p_val_deplete）。内存为 O(n_cols^2)，与置换次数无关；不同块的
+    累加器按 Chan 等人的公式合并。自适应模式下 count 为逐对数组，合并只更新仍在抽样的对。
+    """
+
+    def __init__(self, real_vals: np.ndarray):
+        self.real_vals = real_vals
+        self.count = 0
+        self.mean = np.zeros(real_vals.shape, dtype=np.float64)
+        self.m2 = np.zeros(real_vals.shape, dtype=np.float64)
+        self.n_ge = np.zeros(real_vals.shape, dtype=np.int64)
+        self.n_le = np.zeros(real_vals.shape, dtype=np.int64)
+
+    def update(self, rand_vals: np.ndarray) -> None:
+        self.count += 1
+        delta = rand_vals - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (rand_vals - self.mean)
+        self.n_ge += rand_vals >= self.real_vals
+        self.n_le += rand_vals <= self.real_vals
+
+    def merge(self, other: "NullAccumulator", where: np.ndarray = None) -> "NullAccumulator":
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        if where is None:
+            self.mean += delta * (other.count / count)
+            self.m2 += other.m2 + delta ** 2 * (self.count * other.count / count)
+            self.count = count
+            self.n_ge += other.n_ge
+            self.n_le += other.n_le
+            return self
+
+        self.mean = np.where(where, self.mean + delta * (other.count / count), self.mean)
+        self.m2 = np.where(where, self.m2 + (other.m2 + delta ** 2 * (self.count * other.count / count)), self.m2)
+        self.count = np.where(where, count, self.count)
+        self.n_ge = np.where(where, self.n_ge + other.n_ge, self.n_ge)
+        self.n_le = np.where(where, self.n_le + other.n_le, self.n_le)
+        return self
+
+    @classmethod
+    def from_state(cls, real_vals, count, mean, m2, n_ge, n_le) -> "NullAccumulator":
+        accumulator = cls(real_vals)
+        accumulator.count = count if np.ndim(count) else int(count)
+        accumulator.mean, accumulator.m2 = mean, m2
+        accumulator.n_ge, accumulator.n_le = n_ge, n_le
+        return accumulator
+
+    @property
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.m2 / np.maximum(self.count, 1))
+
+def permutation_block(graph: tuple, real_vals: np.ndarray, targets: np.ndarray, edges_times: int, seeds: np.ndarray,
+                      curveball: bool = False, thin: int = 0) -> NullAccumulator:
+    # 一个 joblib 任务执行一块置换，只返回该块的累加器
+    accumulator = NullAccumulator(real_vals.reshape(-1)[targets])
+    accumulator.count = run_permutation_block(graph, real_vals, targets, edges_times, seeds, curveball, thin,
+                                              accumulator.mean, accumulator.m2, accumulator.n_ge, accumulator.n_le)
+    return accumulator
+
+def scheduled_block(sample: str, block_index: int, *args) -> tuple:
+    # 共享进程池中的任务，返回时带上样本名和块序号
+    return sample, block_index, permutation_block(*args)
+
+def permutation_seeds(seed: int, n_permutations: int) -> np.ndarray:
+    # 每次置换的种子由 SeedSequence 派生，非零（种子 0 表示不重置随机数状态）
+    state = np.random.SeedSequence(seed).generate_state(n_permutations, dtype=np.uint32)
+    return state.astype(np.int64) % (2 ** 32 - 1) + 1
+
+def save_shard(file_name: str, meta: Dict, prepared: Dict[str, Dict], blocks: Dict[str, Dict[int, "NullAccumulator"]]) -> None:
+    # 每个样本：特征名、观测共现矩阵、检验的对、块序号和各块的 count / mean / M2 / 超越计数
+    samples = [sample for sample in prepared if prepared[sample]]
+    arrays = {"meta": np.array(json.dumps({**meta, "samples": samples}))}
+    for i, sample in enumerate(samples):
+        block_ids = sorted(blocks[sample])
+        accumulators = [blocks[sample][b] for b in block_ids]
+        arrays[f"s{i}_cols"] = np.array(prepared[sample]["cols"], dtype=str)
+        arrays[f"s{i}_real_vals"] = prepared[sample]["real_vals"]
+        arrays[f"s{i}_targets"] = prepared[sample]["targets"]
+        arrays[f"s{i}_blocks"] = np.array(block_ids, dtype=np.int64)
+        for field in ["count", "mean", "m2", "n_ge", "n_le"]:
+            arrays[f"s{i}_{field}"] = np.array([getattr(accumulator, field) for accumulator in accumulators])
+    np.savez_compressed(file_name, **arrays)
+
+def load_shards(file_names: List[str]) -> tuple:
+    metas, samples = [], {}
+    for file_name in file_names:
+        with np.load(file_name) as data:
+            meta = json.loads(str(data["meta"]))
+            metas.append(meta)
+            for i, sample in enumerate(meta["samples"]):
+                cols = pd.Index(data[f"s{i}_cols"], name="Info")
+                prepared = {"cols": cols, "real_vals": data[f"s{i}_real_vals"], "targets": data[f"s{i}_targets"]}
+                if sample in samples:
+                    # 各分片必须检验同一组特征对（相同的 --pairs / --subset 和输入）
+                    first = samples[sample][0]
+                    if not (first["cols"].equals(cols) and np.array_equal(first["targets"], prepared["targets"])):
+                        raise ValueError(f"[{sample}] shards were run on different features or feature pairs")
+                prepared, blocks = samples.setdefault(sample, (prepared, {}))
+                states = zip(*(data[f"s{i}_{field}"] for field in ["count", "mean", "m2", "n_ge", "n_le"]))
+                real_targets = prepared["real_vals"].reshape(-1)[prepared["targets"]]
+                for b, state in zip(data[f"s{i}_blocks"], states):
+                    blocks[int(b)] = NullAccumulator.from_state(real_targets, *state)
+
+    settings = [{k: v for k, v in meta.items() if k not in ("shard", "samples")} for meta in metas]
+    if any(setting != settings[0] for setting in settings):
+        raise ValueError("shards were run with different permutation settings")
+    if sorted(meta["shard"] for meta in metas) != list(range(settings[0]["n_shards"])):
+        raise ValueError(f"expected shards 0..{settings[0]['n_shards'] - 1}, got {sorted(meta['shard'] for meta in metas)}")
+    return settings[0], samples
+
+# 长表中的指标列，n_perm 只在自适应模式下输出
+METRICS = ['real', 'z_score', 'diff', 'std_rand', 'log2fc', 'p_enrich', 'q_enrich', 'p_deplete', 'q_deplete', 'n_perm']
+
+def pair_table(cols: pd.Index, a: np.ndarray, b: np.ndarray, metrics: Dict[str, np.ndarray], with_n_perm: bool = True) -> pd.DataFrame:
+    # 长表：每行一对特征 (feature_a, feature_b) 及其各项指标
+    names = np.asarray(cols)
+    table = pd.DataFrame({"feature_a": names[a], "feature_b": names[b]})
+    for metric, values in metrics.items():
+        if metric != "n_perm" or with_n_perm:
+            table[metric] = values
+    return table
+
+def top_k_indices(z: np.ndarray, k: int, chunk_size: int = 1 << 20) -> np.ndarray:
+    # 分块选出 |z| 最大的 k 个下标：每块与当前候选合并后 argpartition，只保留 k 个候选，
+    # 不对全部对排序，也不生成完整长表；NaN（对角线）不参与
+    best = np.zeros(0, dtype=np.int64)
+    for start in range(0, len(z), chunk_size):
+        chunk = np.arange(start, min(start + chunk_size, len(z)))
+        candidates = np.concatenate([best, chunk[~np.isnan(z[chunk])]])
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-np.abs(z[candidates]), k - 1)[:k]]
+        best = candidates
+    # 按 |z| 从大到小，相同时按下标
+    return best[np.lexsort((best, -np.abs(z[best])))]
+
+def build_null_graph(M_binary: sp.csr_matrix, sparse: bool = True) -> tuple:
+    # 边列表（行优先顺序）与行指针直接取自 CSR；默认每行的占用列存为 uint64 位图，不展开稠密矩阵，仅 --dense 时 toarray()
+    n_rows, n_cols = M_binary.shape
+    row_ptr = M_binary.indptr.astype(np.int64)
+    row_indices = np.repeat(np.arange(n_rows, dtype=np.int64), np.diff(row_ptr))
+    col_indices = M_binary.indices.astype(np.int64)
+    if not sparse:
+        return M_binary.toarray(), np.zeros((0, 0), dtype=np.uint64), row_ptr, row_indices, col_indices
+
+    bits = np.zeros((n_rows, (n_cols + 63) // 64), dtype=np.uint64)
+    np.bitwise_or.at(bits, (row_indices, col_indices >> 6), np.left_shift(np.uint64(1), (col_indices & 63).astype(np.uint64)))
+    return np.zeros((0, 0), dtype=np.int8), bits, row_ptr, row_indices, col_indices
 
 class CoOccurrencePermutationTest:
     def __init__(self, 
                  n_permutations: int = 1000, 
                  edges_times: int = 5, 
-                 n_jobs: int = -1):
+                 n_jobs: int = -1,
+                 block_size: int = 50,
+                 engine: str = "numba",
+                 sparse: bool = True,
+                 model: str = "swap",
+                 thin: int = 0,
+                 adaptive_h: int = 0,
+                 seed: int = 42,
+                 cache_dir: str = None,
+                 pairs: List[tuple] = None,
+                 subset: List[str] = None,
+                 top_k: int = 0):
         self.n_permutations = n_permutations
         self.edges_times = edges_times
         self.n_jobs = n_jobs
+        # numba: 单进程内多线程（逐样本为 prange，共享调度为线程池）；joblib: 每块一个进程任务
+        self.engine = engine
+        # sparse（默认）: CSR 边列表 + 位图 + 增量共现，内存随边数增长；False 时展开为稠密矩阵并每次重算 M.T @ M
+        self.sparse = sparse
+        # swap: 边交换；curveball: 行对交易，每次置换 n_rows * edges_times 次交易
+        self.model = model
+        # 0: 每次置换独立从观测矩阵开始；k > 0: 每块一条链，burn-in 后每 k 轮 (sweep) 取样
+        self.thin = thin
+        # Besag–Clifford 序贯停止：某一对的 >= 和 <= 超越次数都达到 h 后不再为其抽样，
+        # 0 表示固定 n_permutations 次；自适应模式下 n_permutations 为上限
+        self.adaptive_h = adaptive_h
+        # 置换种子由 SeedSequence(seed) 派生
+        self.seed = seed
+        # 每个样本的置换结果缓存目录，None 表示不缓存
+        self.cache_dir = cache_dir
+        # 只检验给定的特征对，或 subset 中的特征与所有特征的对；None 表示全矩阵
+        self.pairs = pairs
+        self.subset = subset
+        # 每个样本按 |z| 取前 k 对输出长表，0 表示不输出
+        self.top_k = top_k
+        # 每个任务的置换次数，与 n_jobs 无关，保证结果不随核数变化
+        self.block_size = block_size
 
-    def preprocess(self, df: pd.DataFrame, white_list: List[str], black_list: List[str]) -> pd.DataFrame:
+    def preprocess(self, df: pd.DataFrame, white_list: List[str], black_list: List[str]) -> tuple:
         df_clean = df.copy()
         if white_list:
             df_clean = df_clean[df_clean["Info"].isin(white_list)]
@@ -81,37 +472,266 @@ class CoOccurrencePermutationTest:
         valid_pbs = pb_counts[pb_counts >= 2].index
         df_filtered = df_unique[df_unique['PB'].isin(valid_pbs)]
 
-        df_matrix = pd.crosstab(df_filtered['PB'], df_filtered['Info'])
-        df_matrix = df_matrix.clip(upper=1) 
-        return df_matrix
+        df_filtered = df_filtered.dropna()
 
-    def fit_sample(self, df: pd.DataFrame, sample_name: str, white_list: List[str], black_list: List[str]) -> Dict:
+        # 由排序后的因子编码直接构建 PB x Info 的 int8 CSR 关联矩阵（行列顺序与 crosstab 一致），
+        # 内存随边数增长；已去重，每个位置至多一条边
+        pb_codes, pbs = pd.factorize(df_filtered['PB'], sort=True)
+        info_codes, cols = pd.factorize(df_filtered['Info'], sort=True)
+        M_binary = sp.csr_matrix((np.ones(len(pb_codes), dtype=np.int8), (pb_codes, info_codes)),
+                                 shape=(len(pbs), len(cols)))
+        M_binary.sort_indices()
+        return M_binary, pd.Index(cols, name="Info")
+
+    def run_blocks(self, graph: tuple, real_vals: np.ndarray, targets: np.ndarray, seeds: np.ndarray, sample_name: str):
+        # 按块顺序逐个产出累加器，调用方边收边合并，内存不随块数增长
+        real_vals = np.ascontiguousarray(real_vals, dtype=np.float64)
+        seeds = np.asarray(seeds, dtype=np.int64)
+
+        if self.engine == "numba":
+            n_threads = numba_config.NUMBA_NUM_THREADS if self.n_jobs < 1 else min(self.n_jobs, numba_config.NUMBA_NUM_THREADS)
+            set_num_threads(n_threads)
+            logging.info(f"[{sample_name}] Permuting {len(seeds)} times in {(len(seeds) + self.block_size - 1) // self.block_size} blocks")
+            return self.kernel_waves(graph, real_vals, targets, seeds, n_threads * self.block_size)
+
+        blocks = [seeds[i:i + self.block_size] for i in range(0, len(seeds), self.block_size)]
+        return Parallel(n_jobs=self.n_jobs, return_as="generator")(
+            delayed(permutation_block)(graph, real_vals, targets, self.edges_times, block, self.model == "curveball", self.thin)
+            for block in tqdm(blocks, desc=f"Permuting {sample_name}", leave=False)
+        )
+
+    def kernel_waves(self, graph: tuple, real_vals: np.ndarray, targets: np.ndarray, seeds: np.ndarray, wave_size: int):
+        # 每波 n_threads 块（wave_size 为 block_size 的整数倍，块边界不变），逐波产出累加器，
+        # 内核的块状态数组为 O(n_threads * n_targets)，与置换次数无关
+        for start in range(0, len(seeds), wave_size):
+            states = permutation_blocks_kernel(graph, real_vals, targets, self.edges_times, seeds[start:start + wave_size],
+                                               self.block_size, self.model == "curveball", self.thin)
+            for state in zip(*states):
+                yield NullAccumulator.from_state(real_vals.reshape(-1)[targets], *state)
+
+    def run_adaptive(self, graph: tuple, real_vals: np.ndarray, targets: np.ndarray, seeds: np.ndarray, sample_name: str) -> NullAccumulator:
+        # 按波次抽样，每波的块数翻倍 (2, 4, 8, ... 块)，块边界与固定模式一致。每波结束后，
+        # >= 和 <= 超越次数都已达到 h 的对（双侧都明显不显著）停止累加，其余对继续直到 n_permutations
+        null = NullAccumulator(real_vals.reshape(-1)[targets])
+        null.count = np.zeros(targets.shape, dtype=np.int64)
+        active = np.ones(targets.shape, dtype=bool)
+        start, wave_size = 0, 2 * self.block_size
+        while start < len(seeds) and active.any():
+            for accumulator in self.run_blocks(graph, real_vals, targets, seeds[start:start + wave_size], sample_name):
+                null.merge(accumulator, where=active)
+            start = min(start + wave_size, len(seeds))
+            wave_size *= 2
+            active &= (null.n_ge < self.adaptive_h) | (null.n_le < self.adaptive_h)
+            logging.info(f"[{sample_name}] {start} permutations, {active.sum()} of {active.size} pairs unresolved")
+        return null
+
+    def resolve_targets(self, cols: pd.Index, sample_name: str) -> np.ndarray:
+        # 检验的特征对，存为 n_cols x n_cols 共现矩阵的展平下标。默认全矩阵；
+        # 指定 pairs 或 subset 时只保留 a < b 的上三角对，累加器与输出只覆盖这些对
+        n_cols = len(cols)
+        if self.pairs is None and self.subset is None:
+            return np.arange(n_cols * n_cols, dtype=np.int64)
+
+        if self.pairs is not None:
+            a = cols.get_indexer([pair[0] for pair in self.pairs])
+            b = cols.get_indexer([pair[1] for pair in self.pairs])
+        else:
+            subset = cols.get_indexer(self.subset)
+            subset = subset[subset >= 0]
+            a, b = np.repeat(subset, n_cols), np.tile(np.arange(n_cols), len(subset))
+        found = (a >= 0) & (b >= 0)
+        if self.pairs is not None and not found.all():
+            logging.warning(f"[{sample_name}] {(~found).sum()} of {len(found)} pairs have features not in this sample")
+        keep = found & (a != b)
+        a, b = np.minimum(a[keep], b[keep]), np.maximum(a[keep], b[keep])
+        return np.unique(a.astype(np.int64) * n_cols + b)
+
+    def prepare_sample(self, df: pd.DataFrame, sample_name: str, white_list: List[str], black_list: List[str]) -> Dict:
         logging.info(f"[{sample_name}] Original rows: {len(df)}")
         
-        df_matrix = self.preprocess(df, white_list, black_list)
-        if df_matrix.empty:
+        M_binary_real, cols = self.preprocess(df, white_list, black_list)
+        if M_binary_real.nnz == 0:
             logging.warning(f"[{sample_name}] No valid data after filtering.")
             return {}
 
-        cols = df_matrix.columns
-        n_cols = len(cols)
-        M_binary_real = df_matrix.values.astype(np.float32)
-        real_vals = M_binary_real.T @ M_binary_real
+        # 观测共现：稀疏整数乘积（int8 会溢出，先转 int64），结果只有 n_cols x n_cols
+        M_count = M_binary_real.astype(np.int64)
+        real_vals = np.ascontiguousarray((M_count.T @ M_count).toarray(), dtype=np.float64)
+
+        seeds = permutation_seeds(self.seed, self.n_permutations)
+        targets = self.resolve_targets(cols, sample_name)
+
+        # 边列表只计算一次（行优先顺序），所有块共享
+        return {
+            "cols": cols,
+            "real_vals": real_vals,
+            "targets": targets,
+            "real_targets": real_vals.reshape(-1)[targets],
+            "graph": build_null_graph(M_binary_real, self.sparse),
+            "seeds": np.asarray(seeds, dtype=np.int64),
+        }
 
-        base_rng = np.random.default_rng(seed=42) 
-        seeds = base_rng.integers(0, 1e8, size=self.n_permutations)
+    def cache_key(self, prepared: Dict) -> str:
+        # 预处理后的 0/1 矩阵（特征名、形状、边列表）加上决定置换结果的参数
+        settings = {
+            "n_permutations": self.n_permutations, "edges_times": self.edges_times, "block_size": self.block_size,
+            "model": self.model, "thin": self.thin, "adaptive_h": self.adaptive_h, "seed": self.seed,
+        }
+        _, _, row_ptr, row_indices, col_indices = prepared["graph"]
+        digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+        digest.update("\t".join(map(str, prepared["cols"])).encode())
+        digest.update(np.array([len(row_ptr) - 1, len(prepared["cols"])], dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(row_indices, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(col_indices, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(prepared["targets"], dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+    def load_cache(self, sample_name: str, prepared: Dict):
+        if not self.cache_dir:
+            return None
+        file_name = os.path.join(self.cache_dir, f"{sample_name}.npz")
+        if not os.path.exists(file_name):
+            return None
+        with np.load(file_name) as data:
+            if str(data["key"]) != self.cache_key(prepared):
+                return None
+            logging.info(f"[{sample_name}] Using cached permutation results.")
+            return NullAccumulator.from_state(prepared["real_targets"], *(data[field] for field in ["count", "mean", "m2", "n_ge", "n_le"]))
+
+    def save_cache(self, sample_name: str, prepared: Dict, null: NullAccumulator) -> None:
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        np.savez_compressed(os.path.join(self.cache_dir, f"{sample_name}.npz"), key=np.array(self.cache_key(prepared)),
+                            count=np.array(null.count), mean=null.mean, m2=null.m2, n_ge=null.n_ge, n_le=null.n_le)
+
+    def fit_sample(self, df: pd.DataFrame, sample_name: str, white_list: List[str], black_list: List[str]) -> Dict:
+        prepared = self.prepare_sample(df, sample_name, white_list, black_list)
+        if not prepared:
+            return {}
 
-        # 1. 运行置换检验
-        random_matrices_list = Parallel(n_jobs=self.n_jobs)(
-            delayed(compute_single_permutation_swap)(M_binary_real, self.edges_times, seeds[i])
-            for i in tqdm(range(self.n_permutations), desc=f"Permuting {sample_name}", leave=False)
+        null = self.load_cache(sample_name, prepared)
+        if null is not None:
+            return self.summarize(prepared, null)
+
+        # 1. 运行置换检验，按块累加统计量后按块顺序合并
+        graph, real_vals, targets, seeds = prepared["graph"], prepared["real_vals"], prepared["targets"], prepared["seeds"]
+        if self.adaptive_h > 0:
+            null = self.run_adaptive(graph, real_vals, targets, seeds, sample_name)
+        else:
+            null = NullAccumulator(prepared["real_targets"])
+            for accumulator in self.run_blocks(graph, real_vals, targets, seeds, sample_name):
+                null.merge(accumulator)
+        self.save_cache(sample_name, prepared, null)
+        return self.summarize(prepared, null)
+
+    def plan_units(self, prepared: Dict[str, Dict], shard: int = 0, n_shards: int = 1) -> List[tuple]:
+        # (开销, 样本, 块序号, 种子) 任务，按估计开销 (边数 × edges_times) 从大到小排序。
+        # 分片时每个样本的块按连续区间分给各分片
+        units = []
+        for sample, plan in prepared.items():
+            if not plan:
+                continue
+            n_edges = len(plan["graph"][3])
+            starts = np.arange(0, len(plan["seeds"]), self.block_size)
+            for b in np.array_split(np.arange(len(starts)), n_shards)[shard]:
+                block = plan["seeds"][starts[b]:starts[b] + self.block_size]
+                units.append((n_edges * self.edges_times * len(block), sample, int(b), block))
+        units.sort(key=lambda unit: -unit[0])
+        return units
+
+    def run_units(self, prepared: Dict[str, Dict], units: List[tuple]):
+        # 所有样本的任务提交到同一个池，结果无序返回 (样本, 块序号, 累加器)。
+        # numba: 线程池，run_permutation_block 编译时释放 GIL，各线程直接共享样本数据，无序列化开销；
+        # joblib: 进程池
+        if self.engine == "numba":
+            n_jobs = numba_config.NUMBA_NUM_THREADS if self.n_jobs < 1 else min(self.n_jobs, numba_config.NUMBA_NUM_THREADS)
+            pool = Parallel(n_jobs=n_jobs, prefer="threads", return_as="generator_unordered")
+        else:
+            pool = Parallel(n_jobs=self.n_jobs, return_as="generator_unordered")
+        stream = pool(
+            delayed(scheduled_block)(sample, b, prepared[sample]["graph"], np.asarray(prepared[sample]["real_vals"], dtype=np.float64),
+                                     prepared[sample]["targets"], self.edges_times, block, self.model == "curveball", self.thin)
+            for _, sample, b, block in units
         )
-        
-        random_matrices_array = np.array(random_matrices_list)
-        
+        return tqdm(stream, total=len(units), desc="Permuting", leave=False)
+
+    def fit_samples(self, dfs: Dict[str, pd.DataFrame], white_list: List[str], black_list: List[str]) -> Dict[str, Dict]:
+        # 所有样本的 (样本, 块) 任务共用一个进程池，避免样本之间的等待。
+        # 每个样本缓存提前完成的块并按块顺序合并，与逐样本运行结果一致
+        prepared = {sample: self.prepare_sample(df, sample, white_list, black_list) for sample, df in dfs.items()}
+        results = {sample: {} for sample, plan in prepared.items() if not plan}
+
+        # 缓存命中的样本直接汇总，只为新的或变化的样本提交任务
+        for sample, plan in prepared.items():
+            cached = self.load_cache(sample, plan) if plan else None
+            if cached is not None:
+                results[sample] = self.summarize(plan, cached)
+        prepared = {sample: plan for sample, plan in prepared.items() if sample not in results}
+        units = self.plan_units(prepared)
+
+        nulls = {sample: NullAccumulator(plan["real_targets"]) for sample, plan in prepared.items() if plan}
+        n_blocks = {sample: 0 for sample in nulls}
+        for _, sample, _, _ in units:
+            n_blocks[sample] += 1
+        pending = {sample: {} for sample in nulls}
+        next_block = {sample: 0 for sample in nulls}
+
+        for sample, b, accumulator in self.run_units(prepared, units):
+            pending[sample][b] = accumulator
+            while next_block[sample] in pending[sample]:
+                nulls[sample].merge(pending[sample].pop(next_block[sample]))
+                next_block[sample] += 1
+            if next_block[sample] == n_blocks[sample]:
+                self.save_cache(sample, prepared[sample], nulls[sample])
+                results[sample] = self.summarize(prepared[sample], nulls[sample])
+                logging.info(f"[{sample}] Done.")
+        return {sample: results[sample] for sample in dfs}
+
+    def shard_meta(self, shard: int, n_shards: int) -> Dict:
+        # 决定置换结果的参数，合并时各分片必须一致
+        return {
+            "n_permutations": self.n_permutations, "edges_times": self.edges_times, "block_size": self.block_size,
+            "model": self.model, "thin": self.thin, "seed": self.seed, "shard": shard, "n_shards": n_shards,
+        }
+
+    def run_shard(self, dfs: Dict[str, pd.DataFrame], white_list: List[str], black_list: List[str],
+                  shard: int, n_shards: int, file_name: str) -> None:
+        # 只运行本分片的块，把每块的累加状态写入 npz，由 merge_shards 合并
+        prepared = {sample: self.prepare_sample(df, sample, white_list, black_list) for sample, df in dfs.items()}
+        blocks = {sample: {} for sample, plan in prepared.items() if plan}
+        for sample, b, accumulator in self.run_units(prepared, self.plan_units(prepared, shard, n_shards)):
+            blocks[sample][b] = accumulator
+        save_shard(file_name, self.shard_meta(shard, n_shards), prepared, blocks)
+        logging.info(f"Shard {shard + 1}/{n_shards} written to {file_name}")
+
+    def merge_shards(self, file_names: List[str]) -> Dict[str, Dict]:
+        # 各样本的块按全局块顺序合并，结果与单次运行逐位一致
+        meta, samples = load_shards(file_names)
+        n_blocks = -(-meta["n_permutations"] // meta["block_size"])
+        results = {}
+        for sample, (prepared, blocks) in samples.items():
+            if sorted(blocks) != list(range(n_blocks)):
+                raise ValueError(f"[{sample}] shards cover {len(blocks)} of {n_blocks} blocks")
+            null = NullAccumulator(blocks[0].real_vals)
+            for b in range(n_blocks):
+                null.merge(blocks[b])
+            results[sample] = self.summarize(prepared, null)
+        return results
+
+    def summarize(self, prepared: Dict, null: NullAccumulator) -> Dict:
+        cols, real_vals, targets = prepared["cols"], prepared["real_vals"], prepared["targets"]
+        n_cols = len(cols)
+        # 全矩阵模式还原为 n_cols x n_cols 矩阵，指定对时为 targets 对应的向量
+        full = len(targets) == n_cols * n_cols
+        shape = real_vals.shape if full else targets.shape
+        if not full:
+            real_vals = real_vals.reshape(-1)[targets]
+        n_perm = np.broadcast_to(null.count, targets.shape).astype(np.float64).reshape(shape)
+
         # 2. 基础统计量
-        mean_rand = np.mean(random_matrices_array, axis=0)
-        std_rand = np.std(random_matrices_array, axis=0)
+        mean_rand = null.mean.reshape(shape)
+        std_rand = null.std.reshape(shape)
         diff_matrix = real_vals - mean_rand
         
         with np.errstate(divide='ignore', invalid='ignore'):
@@ -123,18 +743,40 @@ class CoOccurrencePermutationTest:
         
         # 3. 经验 P 值 (Empirical P-value)
         # 计算富集(互作) P值: 随机打乱中，大于等于实际观测值的比例
-        p_val_enrich = np.sum(random_matrices_array >= real_vals, axis=0) / self.n_permutations
+        p_val_enrich = null.n_ge.reshape(shape) / n_perm
         # 为了避免 P=0 导致下游对数计算报错，通常加上伪计数 1/N
-        p_val_enrich = np.maximum(p_val_enrich, 1 / self.n_permutations)
+        p_val_enrich = np.maximum(p_val_enrich, 1 / n_perm)
 
         # 计算排斥(互斥) P值: 随机打乱中，小于等于实际观测值的比例
-        p_val_deplete = np.sum(random_matrices_array <= real_vals, axis=0) / self.n_permutations
-        p_val_deplete = np.maximum(p_val_deplete, 1 / self.n_permutations)
+        p_val_deplete = null.n_le.reshape(shape) / n_perm
+        p_val_deplete = np.maximum(p_val_deplete, 1 / n_perm)
 
         # 4. 效应量 (Log2 Fold Change)
         # 加上伪计数 1 避免 log2(0)，反映观测共现是随机期望的多少倍
         log2fc_matrix = np.log2((real_vals + 1) / (mean_rand + 1))
 
+        if not full:
+            # 指定的对本身就是 a < b 的上三角对，直接校正
+            q_val_enrich = fdrcorrection(p_val_enrich)[1] if len(targets) else np.ones(0)
+            q_val_deplete = fdrcorrection(p_val_deplete)[1] if len(targets) else np.ones(0)
+            a, b = targets // n_cols, targets % n_cols
+            values = [real_vals, z_score_matrix, diff_matrix, std_rand, log2fc_matrix,
+                      p_val_enrich, q_val_enrich, p_val_deplete, q_val_deplete, n_perm]
+        else:
+            a, b, values = self.summarize_matrix(real_vals, z_score_matrix, diff_matrix, std_rand, log2fc_matrix,
+                                                 p_val_enrich, p_val_deplete, n_perm)
+
+        if self.top_k > 0:
+            # 只保留 |z| 最大的 k 对，长表只为这些对生成
+            keep = top_k_indices(values[METRICS.index("z_score")], self.top_k)
+            a, b, values = a[keep], b[keep], [value[keep] for value in values]
+
+        # 长表：每行一对特征及其各项指标
+        return {"pairs": pair_table(cols, a, b, dict(zip(METRICS, values)), self.adaptive_h > 0)}
+
+    def summarize_matrix(self, real_vals, z_score_matrix, diff_matrix, std_rand, log2fc_matrix,
+                         p_val_enrich, p_val_deplete, n_perm) -> tuple:
+        n_cols = len(real_vals)
         # 5. FDR 多重假设检验校正 (只针对上三角矩阵计算，避免对称矩阵导致惩罚过重)
         iu = np.triu_indices(n_cols, k=1) # 提取上三角索引（不包含对角线）
         
@@ -153,20 +795,14 @@ class CoOccurrencePermutationTest:
             q_val_deplete.T[iu] = q_upper_deplete
 
         # 清理对角线 (自身与自身比较无意义)
-        for mat in [diff_matrix, z_score_matrix, std_rand, p_val_enrich, p_val_deplete, q_val_enrich, q_val_deplete, log2fc_matrix]:
+        for mat in [diff_matrix, z_score_matrix, std_rand, p_val_enrich, p_val_deplete, q_val_enrich, q_val_deplete, log2fc_matrix, n_perm]:
             np.fill_diagonal(mat, np.nan)
 
-        return {
-            "real": pd.DataFrame(real_vals, index=cols, columns=cols), 
-            "z_score": pd.DataFrame(z_score_matrix, index=cols, columns=cols),
-            "diff": pd.DataFrame(diff_matrix, index=cols, columns=cols),
-            "std_rand": pd.DataFrame(std_rand, index=cols, columns=cols),
-            "log2fc": pd.DataFrame(log2fc_matrix, index=cols, columns=cols),
-            "p_enrich": pd.DataFrame(p_val_enrich, index=cols, columns=cols),
-            "q_enrich": pd.DataFrame(q_val_enrich, index=cols, columns=cols),
-            "p_deplete": pd.DataFrame(p_val_deplete, index=cols, columns=cols),
-            "q_deplete": pd.DataFrame(q_val_deplete, index=cols, columns=cols),
-        }
+        # 矩阵对称，只保留含对角线的上三角 (对角线保留各特征自身的观测计数)
+        a, b = np.triu_indices(n_cols)
+        values = [real_vals, z_score_matrix, diff_matrix, std_rand, log2fc_matrix,
+                  p_val_enrich, q_val_enrich, p_val_deplete, q_val_deplete, n_perm]
+        return a, b, [mat[a, b] for mat in values]
 
 if __name__ == "__main__":
     args = setup_and_parse_args()
@@ -175,31 +811,58 @@ if __name__ == "__main__":
     summary_permutation_dir = os.path.join(summary_dir, "Permutation")
     os.makedirs(summary_permutation_dir, exist_ok=True)
 
-    samples = args.samples.split()
-    samples.sort()
-
-    # 读取移除MP白名单中的数据
-    results = Parallel(n_jobs=-1)(
-        delayed(load_single_df)(sample, output_dir) for sample in tqdm(samples)
-    )
-    dfs = dict(results)
+    shard_dir = os.path.join(summary_permutation_dir, "shards")
 
-    N_PERMUTATIONS = 1000
+    N_PERMUTATIONS = args.n_permutations
     white_list = []
     black_list = []
 
-    tester = CoOccurrencePermutationTest(n_permutations=N_PERMUTATIONS, n_jobs=-1)
-
-    results = {}
-    for sample in samples:
-        results[sample] = tester.fit_sample(dfs[sample], sample, white_list, black_list)
-        logging.info(f"[{sample}] Done.")
-
-    metrics = ['real', 'z_score', 'diff', 'std_rand', 'log2fc', 'p_enrich', 'q_enrich', 'p_deplete', 'q_deplete']
-    for metric in metrics:
-        file_name = f"{summary_permutation_dir}/Permutation_{metric}.xlsx"
-        with pd.ExcelWriter(file_name) as writer:
-            for sample_name, data_dict in results.items():
-                df = data_dict[metric]
-                sheet_name = sample_name[:31] 
-                df.to_excel(writer, sheet_name=sheet_name)
+    tester = CoOccurrencePermutationTest(n_permutations=N_PERMUTATIONS, n_jobs=-1, engine=args.engine,
+                                         sparse=not args.dense, model=args.model, thin=args.thin,
+                                         adaptive_h=args.adaptive, seed=args.seed,
+                                         cache_dir=None if args.no_cache else os.path.join(summary_permutation_dir, "cache"),
+                                         pairs=pd.read_csv(args.pairs, sep="\t", header=None, dtype=str).values[:, :2].tolist() if args.pairs else None,
+                                         subset=args.subset.split(",") if args.subset else None,
+                                         top_k=args.top_k)
+
+    if args.merge:
+        # 合并各分片，生成与单次运行相同的输出
+        results = tester.merge_shards(sorted(glob.glob(f"{shard_dir}/Permutation_shard_*.npz")))
+    else:
+        samples = args.samples.split()
+        samples.sort()
+
+        # 读取移除MP白名单中的数据
+        results = Parallel(n_jobs=-1)(
+            delayed(load_single_df)(sample, output_dir) for sample in tqdm(samples)
+        )
+        dfs = dict(results)
+
+        if args.shard:
+            shard, n_shards = map(int, args.shard.split("/"))
+            os.makedirs(shard_dir, exist_ok=True)
+            tester.run_shard(dfs, white_list, black_list, shard - 1, n_shards,
+                             f"{shard_dir}/Permutation_shard_{shard}_of_{n_shards}.npz")
+            raise SystemExit(0)
+
+        if args.schedule == "shared" and args.adaptive == 0:
+            results = tester.fit_samples(dfs, white_list, black_list)
+        else:
+            results = {}
+            for sample in samples:
+                results[sample] = tester.fit_sample(dfs[sample], sample, white_list, black_list)
+                logging.info(f"[{sample}] Done.")
+
+    # 主输出：所有样本的长表 (Sample, feature_a, feature_b, 各项指标)，--top_k 时每个样本只有前 k 对
+    store = pd.concat({sample_name: data_dict["pairs"] for sample_name, data_dict in results.items() if data_dict},
+                      names=["Sample"]).reset_index(level=0).reset_index(drop=True)
+    store.to_parquet(f"{summary_permutation_dir}/Permutation.parquet", index=False)
+
+    if args.excel:
+        # 由长表还原每个样本的对称矩阵，每个指标一个 xlsx，每个样本一个 sheet
+        for metric in store.columns[3:]:
+            file_name = f"{summary_permutation_dir}/Permutation_{metric}.xlsx"
+            with pd.ExcelWriter(file_name) as writer:
+                for sample_name, pairs in store.groupby("Sample", sort=False):
+                    sheet_name = sample_name[:31]
+                    permutation_matrix(pairs, metric).to_excel(writer, sheet_name=sheet_name)
@@ -143,22 +143,13 @@ if [ ! -s ${saturation_dir}/${sample}_Downsample.tsv ]; then
         -i ${counts_dir} \
         -o ${saturation_dir} \
         -s ${sample} \
-        -c ${config}
+        -c ${config} \
+        --group_by FB
 else
     log_info "Step 6. Saturation has been calculated for ${sample}"
 fi
 
-# 7. Estimate the Library Size
-
-if [ ! -s ${saturation_dir}/${sample}_Estimation.tsv ]; then
-    log_info "Step 7. Estimate the Library Size for ${sample}"
-    ./scripts/estimate.py \
-        -i ${saturation_dir} \
-        -o ${saturation_dir} \
-        -s ${sample}
-else
-    log_info "Step 7. Library size has been estimated for ${sample}"
-fi
+# 7. The Library Size is estimated for all samples of the batch at once in FBcount
 
 # 8. remove multi-PI molecules if enabled
 if [ "$multi_pi" = true ]; then
@@ -6,12 +6,16 @@ import os
 import matplotlib.pyplot as plt
 from matplotlib.collections import PolyCollection
 from scipy.cluster import hierarchy
-from utils import custom_fonts
+from joblib import Parallel, delayed
+from utils import custom_fonts, permutation_matrix
 import argparse
 
 def setup_and_parse_args():
     parser = argparse.ArgumentParser(description="Barcode Validation.")
     parser.add_argument("-o", "--output", required=True, help="Path to the output path")
+    parser.add_argument("-j", "--n_jobs", type=int, default=-1, help="number of samples rendered in parallel")
+    parser.add_argument("--rasterize", action="store_true",
+                        help="rasterize the diamonds in the PDF (smaller and faster for large panels), labels stay vector")
     args = parser.parse_args()
     return args
 
@@ -32,7 +36,8 @@ def plot_pyramid_heatmap(
         order,
         title=None,
         cmap='RdBu_r',
-        vlim=None):
+        vlim=None,
+        rasterized=False):
 
     num_proteins = len(df)
     cell_size = 0.2
@@ -47,24 +52,12 @@ def plot_pyramid_heatmap(
     n = len(labels)
     data = df.values
 
-    verts = []
-    values = []
-
-    for i in range(n):
-        for j in range(i + 1, n):
-
-            x = (i + j) / 2.0
-            y = (j - i) / 2.0
-
-            diamond = [
-                (x, y - 0.5),
-                (x + 0.5, y),
-                (x, y + 0.5),
-                (x - 0.5, y)
-            ]
-
-            verts.append(diamond)
-            values.append(data[i, j])
+    # 所有 i < j 对的菱形顶点一次性用广播生成，顺序与逐对循环一致
+    i, j = np.triu_indices(n, k=1)
+    centers = np.stack([(i + j) / 2.0, (j - i) / 2.0], axis=1)
+    diamond = np.array([(0, -0.5), (0.5, 0), (0, 0.5), (-0.5, 0)])
+    verts = centers[:, None, :] + diamond[None, :, :]
+    values = data[i, j]
 
     coll = PolyCollection(
         verts,
@@ -73,7 +66,8 @@ def plot_pyramid_heatmap(
         linewidths=1
     )
 
-    coll.set_array(np.array(values))
+    coll.set_array(values)
+    coll.set_rasterized(rasterized)
 
     if vlim is None:
         vmax = np.nanmax(np.abs(values))
@@ -109,26 +103,34 @@ def plot_pyramid_heatmap(
 
     return fig, ax, coll
 
-if __name__ == "__main__":
+def render_sample(sample, df_zscore, order, file_name, rasterized=False):
+    # 在子进程中绘制并保存单个样本，字体设置需在每个进程中重新加载
     custom_fonts(default_font = "Arial")
+    fig, ax, coll = plot_pyramid_heatmap(
+        df_zscore,
+        order=order,
+        title=sample,
+        cmap='RdBu_r',
+        rasterized=rasterized,
+    )
+    fig.savefig(file_name, dpi=300, bbox_inches='tight')
+    plt.close(fig)
+
+if __name__ == "__main__":
     args = setup_and_parse_args()
     summary_dir = os.path.join(args.output, "00_summary")
     summary_permutation_dir = os.path.join(summary_dir, "Permutation")
     heatmap_dir = os.path.join(summary_permutation_dir, "Heatmaps")
     os.makedirs(heatmap_dir, exist_ok=True)
     
-    zscore_dfs = pd.read_excel(f"{summary_permutation_dir}/Permutation_z_score.xlsx", sheet_name=None, index_col=0)
+    store = pd.read_parquet(f"{summary_permutation_dir}/Permutation.parquet", columns=["Sample", "feature_a", "feature_b", "z_score"])
+    zscore_dfs = {sample: permutation_matrix(pairs, "z_score") for sample, pairs in store.groupby("Sample", sort=False)}
 
     df_first = zscore_dfs[list(zscore_dfs.keys())[0]]
     cluster_order = get_cluster_order(df_first)
 
-    for i, (sample, df_zscore) in enumerate(zscore_dfs.items()):
-        fig, ax, coll = plot_pyramid_heatmap(
-            df_zscore,
-            order=cluster_order,
-            title=sample,
-            cmap='RdBu_r',
-        )
-        
-        fig.savefig(f"{heatmap_dir}/Heatmap_{sample}.pdf", dpi=300, bbox_inches='tight')
-        plt.close(fig)
\ No newline at end of file
+    # 各样本在进程池中并行绘制
+    Parallel(n_jobs=args.n_jobs)(
+        delayed(render_sample)(sample, df_zscore, cluster_order, f"{heatmap_dir}/Heatmap_{sample}.pdf", args.rasterize)
+        for sample, df_zscore in zscore_dfs.items()
+    )
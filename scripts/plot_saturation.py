@@ -2,18 +2,55 @@
 
 import pandas as pd
 import plotly.graph_objects as go
+import plotly.express as px
 import plotly.io as pio
 import argparse
 import os
+import sys
 
 def setup_and_parse_args():
     parser = argparse.ArgumentParser(description="generate the report of downsample.")
     parser.add_argument("-s", "--samples", required=True, help="sample names")
     parser.add_argument("-t", "--saturation_template", required=True, help="html template for saturation")
     parser.add_argument("-o", "--output_dir", required=True, help="Path to the output path")
+    parser.add_argument("-g", "--grouped", nargs="*", default=[], choices=["FB", "PB"],
+                        help="also plot the per-group saturation curves of these levels, faceted by group")
+    parser.add_argument("-e", "--export", nargs="*", default=["pdf", "html"], choices=["pdf", "html"],
+                        help="per-sample files written next to the downsample table (html includes the -g per-level pages), pass -e without values to only write the summary html")
     args = parser.parse_args()
     return args
 
+def hex2rgba(color, alpha):
+    color = color.lstrip("#")
+    r, g, b = (int(color[i:i + 2], 16) for i in (0, 2, 4))
+    return f"rgba({r}, {g}, {b}, {alpha})"
+
+def add_band(fig, df, name, color, yaxis):
+    # Draw the percentile band over downsampling replicates if the columns are present
+    band_cols = sorted((col for col in df.columns if col.startswith(f"{name} P")),
+                       key=lambda col: float(col.rsplit(" P", 1)[1]))
+    if len(band_cols) < 2:
+        return
+    lower, upper = band_cols[0], band_cols[-1]
+    fig.add_trace(go.Scatter(
+        x=df["Downsample Ratio"],
+        y=df[upper],
+        name=upper,
+        yaxis=yaxis,
+        line=dict(color=color, width=0),
+        showlegend=False,
+    ))
+    fig.add_trace(go.Scatter(
+        x=df["Downsample Ratio"],
+        y=df[lower],
+        name=lower,
+        yaxis=yaxis,
+        line=dict(color=color, width=0),
+        fill="tonexty",
+        fillcolor=hex2rgba(color, 0.2),
+        showlegend=False,
+    ))
+
 def plot(df, sample):
     color_palette = ["#5963f5", "#e44c39", "#37c58d", "#9c59f5"]
     max_saturation = df["Sequencing Saturation"].max()
@@ -27,6 +64,7 @@ def plot(df, sample):
         yaxis="y3",
         line=dict(color=color_palette[0]),
     ))
+    add_band(fig, df, "Sequencing Saturation", color_palette[0], "y3")
 
     fig.add_trace(go.Scatter(
         x=df["Downsample Ratio"],
@@ -35,6 +73,7 @@ def plot(df, sample):
         yaxis="y3",
         line=dict(color=color_palette[1]),
     ))
+    add_band(fig, df, "Duplication Ratio", color_palette[1], "y3")
 
     fig.add_trace(go.Scatter(
         x=df["Downsample Ratio"],
@@ -43,6 +82,7 @@ def plot(df, sample):
         yaxis="y2",
         line=dict(color=color_palette[2]),
     ))
+    add_band(fig, df, "UMI Types", color_palette[2], "y2")
 
     fig.add_trace(go.Scatter(
             x=df["Downsample Ratio"],
@@ -51,6 +91,7 @@ def plot(df, sample):
             yaxis="y",
             line=dict(color=color_palette[3]),
         ))
+    add_band(fig, df, "UMI detected once", color_palette[3], "y")
 
     # style all the traces
     fig.update_traces(
@@ -129,6 +170,44 @@ def plot(df, sample):
     )
     return fig
 
+def export_images(figs, files, format="pdf"):
+    # Render all static images in one Kaleido session instead of one per sample.
+    # Kaleido >= 1.0 drives a system Chrome; if it is missing, skip the static
+    # images and keep the html outputs instead of failing the pipeline.
+    if not figs:
+        return
+    try:
+        pio.write_images(figs, files, format=format)
+    except RuntimeError as e:
+        print(f"[WARNING] {format} export skipped: {str(e).strip()}\n"
+              f"Kaleido >= 1.0 needs Chrome; install it once with `plotly_get_chrome` "
+              f"(or `python -c \"import kaleido; kaleido.get_chrome_sync()\"`) and rerun.",
+              file=sys.stderr)
+
+def plot_grouped(df, sample, level="FB", metric="Sequencing Saturation"):
+    # Facet the per-group curves of one grouping level, one panel per group
+    df = df[df["Level"] == level]
+    n_groups = df["Group"].nunique()
+    facet_col_wrap = 6
+    fig = px.line(
+        df,
+        x="Downsample Ratio",
+        y=metric,
+        facet_col="Group",
+        facet_col_wrap=facet_col_wrap,
+        facet_row_spacing=min(0.05, 1 / max(1, (n_groups - 1) // facet_col_wrap)),
+        color_discrete_sequence=["#5963f5"],
+        template="plotly_white",
+    )
+    fig.for_each_annotation(lambda a: a.update(text=a.text.split("=", 1)[-1]))
+    fig.update_yaxes(range=[0, 100] if metric in ["Sequencing Saturation", "Duplication Ratio"] else None)
+    fig.update_layout(
+        title=dict(text=f"{sample}--{metric} per {level}", x=0.5),
+        height=max(500, 200 * -(-n_groups // facet_col_wrap)),
+        width=1200,
+    )
+    return fig
+
 if __name__ == "__main__":
     args = setup_and_parse_args()
     samples = args.samples.split()
@@ -137,17 +216,30 @@ if __name__ == "__main__":
     summary_dir = os.path.join(output_dir, "00_summary")
     
     fig_html_list = []
+    pdf_figs, pdf_files = [], []
     for sample in samples:
         saturation_dir = os.path.join(output_dir, sample, "04_saturation")
         file = os.path.join(saturation_dir, f"{sample}_Downsample.tsv")
         df = pd.read_csv(file, sep="\t")
         fig = plot(df, sample)
         fig_html = fig.to_html(full_html=False, include_plotlyjs='cdn')
-        fig.write_html(f"{saturation_dir}/{sample}_Downsample.html", auto_open=False, full_html=True, include_plotlyjs='cdn')
-        pio.full_figure_for_development(fig, warn=False)
-        fig.write_image(f"{saturation_dir}/{sample}_Downsample.pdf", format='pdf')
+        if "html" in args.export:
+            fig.write_html(f"{saturation_dir}/{sample}_Downsample.html", auto_open=False, full_html=True, include_plotlyjs='cdn')
+        if "pdf" in args.export:
+            pdf_figs.append(fig)
+            pdf_files.append(f"{saturation_dir}/{sample}_Downsample.pdf")
         fig_html_list.append(fig_html)
 
+        grouped_file = os.path.join(saturation_dir, f"{sample}_Downsample_grouped.tsv")
+        if args.grouped and "html" in args.export and os.path.exists(grouped_file):
+            df_grouped = pd.read_csv(grouped_file, sep="\t")
+            for level in args.grouped:
+                if (df_grouped["Level"] == level).any():
+                    fig = plot_grouped(df_grouped, sample, level)
+                    fig.write_html(f"{saturation_dir}/{sample}_Downsample_{level}.html", auto_open=False, full_html=True, include_plotlyjs='cdn')
+
+    export_images(pdf_figs, pdf_files, format="pdf")
+
     figs_html = "\n".join(f'<div class="plot">{fig_html}</div>' for fig_html in fig_html_list)
 
     with open(saturation_template, "r", encoding="utf-8") as f:
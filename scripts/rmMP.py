@@ -1,10 +1,18 @@
 #! /usr/bin/env python
 
+import numpy as np
 import pandas as pd
 from collections import defaultdict
 import json
 import argparse
 import os
+import gzip
+import zlib
+import shutil
+import tempfile
+import multiprocessing
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from utils import read_json_config, fa2df
 
 
@@ -14,10 +22,225 @@ def setup_and_parse_args():
     parser.add_argument("-i", "--input_dir", required=True, help="Path to the input path")
     parser.add_argument("-o", "--output_dir", required=True, help="Path to the output path")
     parser.add_argument("-c", "--config", required=True, help="Path to the config json")
+    parser.add_argument("--engine", default="columnar", choices=["columnar", "pandas"],
+                        help="columnar: integer coded molecules with one sort and segmented reductions; pandas: the original implementation")
+    parser.add_argument("-p", "--partitions", type=int, default=0,
+                        help="hash partition the molecules into N on-disk partitions processed independently (out-of-core), 0 to run in memory")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="number of processes for the partitions")
+    parser.add_argument("--threshold", type=float, default=0.8, help="dominance ratio above which the top PB of a multi-PB molecule is kept")
+    parser.add_argument("--sweep", default="", help="comma separated dominance thresholds reported in MP_Report_sweep.tsv")
+    parser.add_argument("--hamming", action="store_true",
+                        help="also collide UMIs of one FB that differ by one base across PBs, the dominance rule is applied to the collision components")
     args = parser.parse_args()
+    if (args.sweep or args.hamming) and args.engine != "columnar":
+        parser.error("--sweep and --hamming need the columnar engine")
+    if args.partitions > 0 and args.engine != "columnar":
+        parser.error("-p/--partitions needs the columnar engine")
     return args
 
-def rmMP(json_file, FB_info, FB_info_all, sample_name):
+def encode_molecules(fbs, umis, pbs, reads):
+    # Integer coded molecule table, one entry per PB x FB_UMI. FB codes follow the order of
+    # FB + "_" and UMI codes the UMI order, so sorting by (FB, UMI) codes equals sorting FB_UMI strings
+    fb_names = np.array(sorted(pd.unique(fbs), key=lambda fb: fb + "_"), dtype=object)
+    fb_codes = pd.Categorical(fbs, categories=fb_names).codes.astype(np.int64)
+    umi_codes, umi_names = pd.factorize(umis, sort=True)
+    pb_codes, pb_names = pd.factorize(pbs)
+    return {
+        "fb": fb_codes,
+        "umi": umi_codes.astype(np.int64),
+        "pb": pb_codes.astype(np.int64),
+        "reads": np.asarray(reads, dtype=np.int64),
+        "fb_names": fb_names,
+        "umi_names": np.asarray(umi_names, dtype=object),
+        "pb_names": np.asarray(pb_names, dtype=object),
+    }
+
+def load_molecules(json_file):
+    with open(json_file, "r") as f:
+        data = json.load(f)
+
+    sizes = np.fromiter((len(umi_dict) for umi_dict in data.values()), dtype=np.int64, count=len(data))
+    pbs, fbs = zip(*(pb_fb.split("_") for pb_fb in data)) if data else ((), ())
+    umis = pd.Series([umi for umi_dict in data.values() for umi in umi_dict], dtype=object)
+    reads = np.fromiter((umi_reads for umi_dict in data.values() for umi_reads in umi_dict.values()),
+                        dtype=np.int64, count=int(sizes.sum()))
+    return encode_molecules(np.repeat(np.array(fbs, dtype=object), sizes), umis,
+                            np.repeat(np.array(pbs, dtype=object), sizes), reads)
+
+def sort_molecules(molecules):
+    # One sort by (FB, UMI, -Reads) puts every FB_UMI in a contiguous segment with its top PB first
+    fb, umi, pb, reads = molecules["fb"], molecules["umi"], molecules["pb"], molecules["reads"]
+    order = np.lexsort((-reads, umi, fb))
+    fb, umi, pb, reads = fb[order], umi[order], pb[order], reads[order]
+
+    new_segment = np.ones(len(fb), dtype=bool)
+    new_segment[1:] = (fb[1:] != fb[:-1]) | (umi[1:] != umi[:-1])
+    return fb, umi, pb, reads, np.flatnonzero(new_segment)
+
+def molecule_segments(molecules):
+    # num_pbs / total_reads / max_reads / top PB of every FB_UMI are segmented reductions over the
+    # sorted rows. Candidates are the top PB rows of multi-PB molecules sorted by dominance ratio,
+    # so any threshold is a single searchsorted
+    fb, umi, pb, reads, starts = sort_molecules(molecules)
+    num_pbs = np.diff(np.append(starts, len(fb)))
+    total_reads = np.add.reduceat(reads, starts) if len(starts) else reads[:0]
+    max_reads = reads[starts]
+
+    multi_pb = num_pbs > 1
+    dominance_ratio = max_reads / total_reads
+
+    multi_idx = np.flatnonzero(multi_pb)
+    by_dominance = multi_idx[np.argsort(dominance_ratio[multi_idx], kind="stable")]
+    return {
+        "fb": fb, "umi": umi, "pb": pb, "reads": reads,
+        "total": len(starts), "multi": len(multi_idx), "single_rows": starts[~multi_pb],
+        "by_dominance": starts[by_dominance], "sorted_dominance": dominance_ratio[by_dominance],
+    }
+
+def pack_umis(umi_names):
+    # 3 bits per base, base codes start at 1 so the padding of shorter UMIs never equals a base
+    base_codes = np.full(256, 7, dtype=np.int64)
+    base_codes[np.frombuffer(b"ACGTN", dtype=np.uint8)] = np.arange(1, 6)
+    lengths = np.fromiter(map(len, umi_names), dtype=np.int64, count=len(umi_names))
+    max_len = int(lengths.max()) if len(lengths) else 0
+    if max_len > 20:
+        raise ValueError(f"UMIs of {max_len} bases are too long to pack, at most 20 bases are supported")
+
+    chars = np.frombuffer("".join(umi_names).encode(), dtype=np.uint8)
+    rows = np.repeat(np.arange(len(umi_names)), lengths)
+    cols = np.arange(len(chars)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    packed = np.zeros(len(umi_names), dtype=np.int64)
+    np.add.at(packed, rows, base_codes[chars] << (3 * cols))
+    return packed, lengths, max_len
+
+def umi_components(seg_fb, seg_umi, umi_names):
+    # Cross-PB collision graph of FB_UMI molecules: two molecules of the same FB are linked when
+    # their UMIs have the same length and differ at one position. For each position the base is
+    # masked out of the packed UMI, molecules sharing (FB, length, masked UMI) are Hamming-1
+    # neighbors and are linked to the first of their run, connected components are the collisions
+    packed, lengths, max_len = pack_umis(umi_names)
+    packed, lengths = packed[seg_umi], lengths[seg_umi]
+    heads, tails = [], []
+    for pos in range(max_len):
+        masked = packed & ~np.int64(7 << (3 * pos))
+        order = np.lexsort((masked, lengths, seg_fb))
+        key_fb, key_len, key_umi = seg_fb[order], lengths[order], masked[order]
+        new_key = np.ones(len(order), dtype=bool)
+        new_key[1:] = (key_fb[1:] != key_fb[:-1]) | (key_len[1:] != key_len[:-1]) | (key_umi[1:] != key_umi[:-1])
+        run_start = np.maximum.accumulate(np.where(new_key, np.arange(len(order)), 0))
+        linked = ~new_key
+        heads.append(order[run_start[linked]])
+        tails.append(order[linked])
+
+    heads = np.concatenate(heads) if heads else np.empty(0, dtype=np.int64)
+    tails = np.concatenate(tails) if tails else np.empty(0, dtype=np.int64)
+    graph = coo_matrix((np.ones(len(heads), dtype=np.int32), (heads, tails)), shape=(len(seg_fb), len(seg_fb)))
+    return connected_components(graph, directed=False)[1]
+
+def molecule_components(molecules):
+    # Same output as molecule_segments with the dominance rule applied to Hamming-1 collision
+    # components instead of exact FB_UMI: reads are summed per PB over the component and the rows
+    # of the top PB are the candidates, one per molecule of the component
+    fb, umi, pb, reads, starts = sort_molecules(molecules)
+    seg_of_row = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(fb))))
+    seg_comp = umi_components(fb[starts], umi[starts], molecules["umi_names"])
+    comp = seg_comp[seg_of_row]
+
+    # reads per (component, PB), first row breaks ties like the top PB of a segment
+    rows = np.arange(len(fb))
+    order = np.lexsort((rows, pb, comp))
+    pair_start = np.ones(len(order), dtype=bool)
+    pair_start[1:] = (comp[order][1:] != comp[order][:-1]) | (pb[order][1:] != pb[order][:-1])
+    pair_idx = np.flatnonzero(pair_start)
+    pair_comp, pair_pb = comp[order][pair_idx], pb[order][pair_idx]
+    pair_first = order[pair_idx]
+    pair_reads = np.add.reduceat(reads[order], pair_idx) if len(pair_idx) else reads[:0]
+
+    n_comp = int(seg_comp.max()) + 1 if len(seg_comp) else 0
+    num_pbs = np.bincount(pair_comp, minlength=n_comp)
+    total_reads = np.bincount(pair_comp, weights=pair_reads, minlength=n_comp)
+    top = np.lexsort((pair_first, -pair_reads, pair_comp))
+    top = top[np.flatnonzero(np.diff(np.append(-1, pair_comp[top])))]
+    top_pb, max_reads = pair_pb[top], pair_reads[top]
+
+    multi_pb = num_pbs > 1
+    dominance_ratio = np.divide(max_reads, total_reads, out=np.zeros(n_comp), where=total_reads > 0)
+    candidates = np.flatnonzero(multi_pb[comp] & (pb == top_pb[comp]))
+    by_dominance = candidates[np.argsort(dominance_ratio[comp[candidates]], kind="stable")]
+    return {
+        "fb": fb, "umi": umi, "pb": pb, "reads": reads,
+        "total": len(starts), "multi": int(multi_pb[seg_comp].sum()), "single_rows": np.flatnonzero(~multi_pb[comp]),
+        "by_dominance": by_dominance, "sorted_dominance": dominance_ratio[comp[by_dominance]],
+    }
+
+def clean_segments(segments, molecules, threshold=0.8):
+    fb, umi, pb, reads = segments["fb"], segments["umi"], segments["pb"], segments["reads"]
+    first_dominant = np.searchsorted(segments["sorted_dominance"], threshold, side="right")
+    dominant_rows = np.sort(segments["by_dominance"][first_dominant:])
+
+    # dominant PBs first, then single PB molecules, both in FB_UMI order
+    keep = np.concatenate([dominant_rows, segments["single_rows"]])
+    fb_keep = pd.Series(molecules["fb_names"][fb[keep]], dtype=object)
+    umi_keep = pd.Series(molecules["umi_names"][umi[keep]], dtype=object)
+    df_cleaned = pd.DataFrame({
+        "FB_UMI": fb_keep + "_" + umi_keep,
+        "PB": molecules["pb_names"][pb[keep]],
+        "Reads": reads[keep],
+        "FB": fb_keep,
+        "UMI": umi_keep,
+    })
+    return df_cleaned, segments["total"], segments["multi"], len(dominant_rows)
+
+def rmMP_columnar(molecules, threshold=0.8):
+    return clean_segments(molecule_segments(molecules), molecules, threshold)
+
+def sweep_counts(segments, molecules, FB_info):
+    # Counts needed by the threshold sweep: single-PB molecules and the sorted dominance ratios of
+    # the multi-PB candidates, each with its number of rows after the whitelist merge
+    wl_rows = FB_info["FB"].value_counts().reindex(molecules["fb_names"], fill_value=0).to_numpy()
+    return {
+        "total": segments["total"],
+        "multi": segments["multi"],
+        "single": len(segments["single_rows"]),
+        "single_wl": int(wl_rows[segments["fb"][segments["single_rows"]]].sum()),
+        "dominance": segments["sorted_dominance"],
+        "dominance_wl": wl_rows[segments["fb"][segments["by_dominance"]]],
+    }
+
+def merge_sweep_counts(sweeps):
+    dominance = np.concatenate([sweep["dominance"] for sweep in sweeps])
+    order = np.argsort(dominance, kind="stable")
+    return {
+        "total": sum(sweep["total"] for sweep in sweeps),
+        "multi": sum(sweep["multi"] for sweep in sweeps),
+        "single": sum(sweep["single"] for sweep in sweeps),
+        "single_wl": sum(sweep["single_wl"] for sweep in sweeps),
+        "dominance": dominance[order],
+        "dominance_wl": np.concatenate([sweep["dominance_wl"] for sweep in sweeps])[order],
+    }
+
+def sweep_report(sample_name, sweep, thresholds):
+    # MP_Report metrics for every threshold from the sorted dominance ratios, without recomputation
+    dominance = sweep["dominance"]
+    wl_above = np.append(np.cumsum(sweep["dominance_wl"][::-1])[::-1], 0)
+    reports = []
+    for threshold in thresholds:
+        first_dominant = np.searchsorted(dominance, threshold, side="right")
+        dominant_cnt = len(dominance) - first_dominant
+        stats_df = report_stats(sample_name, sweep["total"], sweep["multi"], dominant_cnt,
+                                sweep["single"] + dominant_cnt, sweep["single_wl"] + int(wl_above[first_dominant]))
+        stats_df.insert(1, "Threshold", threshold)
+        reports.append(stats_df)
+    return pd.concat(reports, ignore_index=True)
+
+def rmMP(json_file, FB_info, FB_info_all, sample_name, engine="columnar", threshold=0.8, thresholds=(), hamming=False):
+
+    if engine == "columnar":
+        molecules = load_molecules(json_file)
+        segments = molecule_components(molecules) if hamming else molecule_segments(molecules)
+        df_cleaned, total_fb_umi, multi_pb_cnt, dominant_cnt = clean_segments(segments, molecules, threshold)
+        sweep_df = sweep_report(sample_name, sweep_counts(segments, molecules, FB_info), thresholds) if thresholds else None
+        return (*report_cleaned(df_cleaned, total_fb_umi, multi_pb_cnt, dominant_cnt, FB_info, FB_info_all, sample_name), sweep_df)
 
     with open(json_file, "r") as f:
         data = json.load(f)
@@ -36,7 +259,6 @@ def rmMP(json_file, FB_info, FB_info_all, sample_name):
     ], columns=['FB_UMI', 'PB', 'Reads'])
 
     # --- 2. 统计计算 ---
-    threshold = 0.8
     summary = df.groupby('FB_UMI').agg(
         num_pbs=('PB', 'nunique'),
         total_reads=('Reads', 'sum'),
@@ -65,26 +287,33 @@ def rmMP(json_file, FB_info, FB_info_all, sample_name):
     
     df_cleaned = pd.concat([dominant_keeps, single_pb_keeps], ignore_index=True)
 
-    # --- 4. 白名单处理 ---
     df_cleaned["FB"] = df_cleaned["FB_UMI"].apply(lambda x: x.split("_")[0])
     df_cleaned["UMI"] = df_cleaned["FB_UMI"].apply(lambda x: x.split("_")[1])
+    return (*report_cleaned(df_cleaned, len(summary), len(result_df), result_df['is_dominant'].sum(), FB_info, FB_info_all, sample_name), None)
+
+def report_cleaned(df_cleaned, total_fb_umi, multi_pb_cnt, dominant_cnt, FB_info, FB_info_all, sample_name):
+    # --- 4. 白名单处理 ---
     df_cleaned_WL = df_cleaned.merge(FB_info, on="FB")
 
     # --- 5. Top 5 Not in WL 处理 ---
+    FB_not_in_WL = format_not_in_WL(count_not_in_WL(df_cleaned, FB_info, FB_info_all), FB_info_all)
+
+    # --- 6. 生成统计指标 DataFrame ---
+    stats_df = report_stats(sample_name, total_fb_umi, multi_pb_cnt, dominant_cnt, len(df_cleaned), len(df_cleaned_WL))
+    return df_cleaned, df_cleaned_WL, FB_not_in_WL, stats_df
+
+def count_not_in_WL(df_cleaned, FB_info, FB_info_all):
     df_not_in_WL = df_cleaned[~df_cleaned["FB"].isin(FB_info["FB"])]
     df_not_in_WL = df_not_in_WL.merge(FB_info_all, on="FB", how="left")
-    FB_not_in_WL = df_not_in_WL["FB_num"].value_counts().reset_index()
+    return df_not_in_WL["FB_num"].value_counts()
+
+def format_not_in_WL(fb_num_counts, FB_info_all):
+    FB_not_in_WL = fb_num_counts.reset_index()
     FB_not_in_WL.columns = ["FB_num", "count"]
-    FB_not_in_WL = FB_not_in_WL.merge(FB_info_all, on="FB_num", how="left")
+    return FB_not_in_WL.merge(FB_info_all, on="FB_num", how="left")
 
-    # --- 6. 生成统计指标 DataFrame ---
+def report_stats(sample_name, total_fb_umi, multi_pb_cnt, dominant_cnt, final_cleaned_cnt, final_wl_cnt):
     # 计算各项数值
-    total_fb_umi = len(summary)
-    multi_pb_cnt = len(result_df)
-    dominant_cnt = result_df['is_dominant'].sum()
-    final_cleaned_cnt = len(df_cleaned)
-    final_wl_cnt = len(df_cleaned_WL)
-
     multi_pb_pct = multi_pb_cnt / total_fb_umi if total_fb_umi > 0 else 0
     dominant_in_multi_pct = dominant_cnt / multi_pb_cnt if multi_pb_cnt > 0 else 0
     clean_remove_pct = 1 - final_cleaned_cnt / total_fb_umi if total_fb_umi > 0 else 0
@@ -103,8 +332,127 @@ def rmMP(json_file, FB_info, FB_info_all, sample_name):
         "WL_Pct": wl_pct
     }
     stats_df = pd.DataFrame([stats_data])
-    
-    return df_cleaned, df_cleaned_WL, FB_not_in_WL, stats_df
+    return stats_df
+
+def iter_json_object(json_file, chunk_size=1 << 20):
+    # Stream the (key, value) pairs of a top-level JSON object. The file is read in chunks and
+    # only one value is decoded at a time, so memory is bounded by the largest value
+    decoder = json.JSONDecoder()
+    with open(json_file, "r") as f:
+        buf, pos, eof = "", 0, False
+
+        def read_more():
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+
+        def peek():
+            # Next non-whitespace character without consuming it, "" at the end of the file
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in " \t\n\r":
+                    pos += 1
+                if pos < len(buf) or eof:
+                    return buf[pos] if pos < len(buf) else ""
+                read_more()
+
+        def decode():
+            nonlocal pos
+            peek()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    # a number at the end of the buffer may continue in the next chunk
+                    if end < len(buf) or eof:
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                read_more()
+
+        def expect(chars):
+            nonlocal pos
+            char = peek()
+            if char not in chars or not char:
+                raise ValueError(f"{json_file}: expected one of {chars!r} at offset {f.tell() - len(buf) + pos}")
+            pos += 1
+            return char
+
+        expect("{")
+        if peek() == "}":
+            return
+        while True:
+            key = decode()
+            expect(":")
+            yield key, decode()
+            if expect(",}") == "}":
+                return
+
+def partition_molecules(json_file, partition_dir, n_partitions, by_fb=False):
+    # Hash partition the molecules by FB_UMI into tsv files. crc32 is stable across processes and
+    # every PB of one FB_UMI lands in the same partition, so partitions can be processed independently.
+    # Collision components span UMIs of one FB, with by_fb the whole FB goes to one partition.
+    # The json is streamed, molecules are written to their partition as they are parsed
+    part_files = [os.path.join(partition_dir, f"part_{i}.tsv") for i in range(n_partitions)]
+    handles = [open(part_file, "w") for part_file in part_files]
+    for pb_fb, umi_dict in iter_json_object(json_file):
+        pb, fb = pb_fb.split("_")
+        for umi, umi_reads in umi_dict.items():
+            key = fb if by_fb else f"{fb}_{umi}"
+            handles[zlib.crc32(key.encode()) % n_partitions].write(f"{fb}\t{umi}\t{pb}\t{umi_reads}\n")
+    for handle in handles:
+        handle.close()
+    return part_files
+
+def process_partition(task):
+    # Remove multi-PI molecules of one partition, the cleaned tables are written next to the
+    # partition without header and only the counts go back to the parent process
+    part_file, FB_info, FB_info_all, threshold, hamming = task
+    df = pd.read_csv(part_file, sep="\t", header=None, names=["FB", "UMI", "PB", "Reads"],
+                     dtype={"FB": object, "UMI": object, "PB": object, "Reads": np.int64}, keep_default_na=False)
+    molecules = encode_molecules(df["FB"], df["UMI"], df["PB"], df["Reads"])
+    del df
+    segments = molecule_components(molecules) if hamming else molecule_segments(molecules)
+    df_cleaned, total_fb_umi, multi_pb_cnt, dominant_cnt = clean_segments(segments, molecules, threshold)
+    df_cleaned_WL = df_cleaned.merge(FB_info, on="FB")
+    df_cleaned.to_csv(f"{part_file}.all.gz", sep="\t", index=False, header=False, compression="gzip")
+    df_cleaned_WL.to_csv(f"{part_file}.WL.gz", sep="\t", index=False, header=False, compression="gzip")
+    return {
+        "counts": (total_fb_umi, multi_pb_cnt, dominant_cnt, len(df_cleaned), len(df_cleaned_WL)),
+        "not_in_WL": count_not_in_WL(df_cleaned, FB_info, FB_info_all),
+        "columns": (list(df_cleaned.columns), list(df_cleaned_WL.columns)),
+        "sweep": sweep_counts(segments, molecules, FB_info),
+    }
+
+def concat_gzip(files, header, out_file):
+    # gzip members can be concatenated, the partitions are appended without decompression
+    with open(out_file, "wb") as out:
+        out.write(gzip.compress(("\t".join(header) + "\n").encode()))
+        for file in files:
+            with open(file, "rb") as f:
+                shutil.copyfileobj(f, out)
+
+def rmMP_partitioned(json_file, FB_info, FB_info_all, sample_name, output_dir, n_partitions, threads=1, threshold=0.8, thresholds=(), hamming=False):
+    # Out-of-core multi-PI removal: only one partition per worker is in memory, the per-partition
+    # counts are summed into the report and the cleaned tables are concatenated in partition order
+    with tempfile.TemporaryDirectory(dir=output_dir) as partition_dir:
+        part_files = partition_molecules(json_file, partition_dir, n_partitions, by_fb=hamming)
+        tasks = [(part_file, FB_info, FB_info_all, threshold, hamming) for part_file in part_files]
+        with multiprocessing.Pool(processes=threads) as pool:
+            results = pool.map(process_partition, tasks)
+
+        counts = np.sum([result["counts"] for result in results], axis=0).tolist()
+        not_in_WL = pd.concat([result["not_in_WL"] for result in results])
+        not_in_WL = not_in_WL.groupby(level=0).sum().sort_values(ascending=False)
+        FB_not_in_WL = format_not_in_WL(not_in_WL, FB_info_all)
+        stats_df = report_stats(sample_name, *counts)
+        sweep_df = sweep_report(sample_name, merge_sweep_counts([result["sweep"] for result in results]), thresholds) if thresholds else None
+
+        columns_all, columns_WL = results[0]["columns"]
+        concat_gzip([f"{part_file}.all.gz" for part_file in part_files], columns_all, f"{output_dir}/df_rmMP_all.tsv.gz")
+        concat_gzip([f"{part_file}.WL.gz" for part_file in part_files], columns_WL, f"{output_dir}/df_rmMP_WL.tsv.gz")
+    return FB_not_in_WL, stats_df, sweep_df
 
 if __name__ == "__main__":
     args = setup_and_parse_args()
@@ -123,10 +471,17 @@ if __name__ == "__main__":
 
     json_file = os.path.join(input_dir, f"{sample}_dic_after_downsample.json")
     
-    df_cleaned, df_cleaned_WL, FB_not_in_WL, stats_df = rmMP(json_file, FB_info, FB_info_all, sample)
+    thresholds = [float(threshold) for threshold in args.sweep.split(",") if threshold]
+    if args.partitions > 0:
+        FB_not_in_WL, stats_df, sweep_df = rmMP_partitioned(json_file, FB_info, FB_info_all, sample, output_dir,
+                                                            args.partitions, args.threads, args.threshold, thresholds, args.hamming)
+    else:
+        df_cleaned, df_cleaned_WL, FB_not_in_WL, stats_df, sweep_df = rmMP(json_file, FB_info, FB_info_all, sample,
+                                                                          args.engine, args.threshold, thresholds, args.hamming)
+        df_cleaned.to_csv(f"{output_dir}/df_rmMP_all.tsv.gz", sep="\t", index=False, compression="gzip")
+        df_cleaned_WL.to_csv(f"{output_dir}/df_rmMP_WL.tsv.gz", sep="\t", index=False, compression="gzip")
 
     stats_df.to_csv(f"{output_dir}/MP_Report.tsv", index=False, sep="\t")
     FB_not_in_WL.to_csv(f"{output_dir}/FB_not_in_WL.tsv", index=False, sep="\t")
-
-    df_cleaned.to_csv(f"{output_dir}/df_rmMP_all.tsv.gz", sep="\t", index=False, compression="gzip")
-    df_cleaned_WL.to_csv(f"{output_dir}/df_rmMP_WL.tsv.gz", sep="\t", index=False, compression="gzip")
\ No newline at end of file
+    if sweep_df is not None:
+        sweep_df.to_csv(f"{output_dir}/MP_Report_sweep.tsv", index=False, sep="\t")
\ No newline at end of file
@@ -3,6 +3,7 @@ import re
 import gzip
 from itertools import zip_longest
 from datetime import datetime
+import numpy as np
 import pandas as pd
 import matplotlib.font_manager as fm
 import matplotlib as mpl
@@ -148,6 +149,31 @@ def write_dict_to_tsv(data_dict, filename, per_barcode1_len, barcode2_dict):
             # Write key and value separated by a tab, and end with a newline
             file.write(f"{barcode1}\t{barcode2}\t{value}\n")
 
+def write_umi_hist(umi_hists, filename, barcode2_dict):
+    # Reads-per-UMI histograms per correction stage and FB, plus the overall histogram as "All"
+    rows = []
+    for stage, fb_hists in umi_hists.items():
+        overall = {}
+        named_hists = {}
+        for fb, hist in fb_hists.items():
+            name = barcode2_dict.get(fb, fb)
+            named_hist = named_hists.setdefault(name, {})
+            for reads, umis in hist.items():
+                named_hist[reads] = named_hist.get(reads, 0) + umis
+                overall[reads] = overall.get(reads, 0) + umis
+        for name, hist in [("All", overall)] + sorted(named_hists.items()):
+            rows.extend((stage, name, reads, umis) for reads, umis in sorted(hist.items()))
+    df = pd.DataFrame(rows, columns=["Stage", "FB", "Reads per UMI", "UMIs"])
+    df.to_csv(filename, sep="\t", index=False)
+
+def read_umi_hist(filename, stage="after_correct", fb="All"):
+    # hist[k] is the number of UMIs supported by k reads
+    df = pd.read_csv(filename, sep="\t")
+    df = df[(df["Stage"] == stage) & (df["FB"] == fb)]
+    hist = np.zeros(df["Reads per UMI"].max() + 1 if len(df) else 1, dtype=np.int64)
+    hist[df["Reads per UMI"].values] = df["UMIs"].values
+    return hist
+
 def save_dict_to_pkl(dictionary, filepath):
     with open(filepath, 'w') as f:
         for read_name, (barcode, quality) in dictionary.items():
@@ -224,4 +250,14 @@ def draw_stacked_bar_plot(df_pct_umi, df_pct_fb, samples):
     ax.set_title("nUMIs per PB vs FB per PB")
     ax.set_xticks(x)
     ax.set_xticklabels(samples, rotation=45, ha="right")
-    ax.legend(title=None, bbox_to_anchor=(1.02, 1), loc="upper left")
\ No newline at end of file
+    ax.legend(title=None, bbox_to_anchor=(1.02, 1), loc="upper left")
+
+def permutation_matrix(pairs, metric):
+    # Rebuild the symmetric matrix of one metric from the long permutation table, features in order of appearance
+    features = pd.Index(pd.unique(pairs[["feature_a", "feature_b"]].values.ravel()), name="Info")
+    a = features.get_indexer(pairs["feature_a"])
+    b = features.get_indexer(pairs["feature_b"])
+    matrix = np.full((len(features), len(features)), np.nan)
+    matrix[a, b] = pairs[metric].values
+    matrix[b, a] = pairs[metric].values
+    return pd.DataFrame(matrix, index=features, columns=features)